@@ -1,392 +1,430 @@
 import argparse
 import json
-import os
 import sys
-from copy import deepcopy
+from typing import Iterable
 
+import numpy as np
 import pandas as pd
-from tqdm import tqdm
 
 from config import end_data_year, start_data_year
+from plays import STATS_COLUMNS, GroupedCounts, cached_counts, data_files, write_table
 
+event_code_to_event = {
+    2: "Out",
+    3: "K",
+    4: "SB",
+    6: "CS",
+    14: "BB",
+    15: "BB",  # IBB, basically a walk
+    16: "HBP",
+    18: "PA",  # Error, just count it as a PA
+    20: "1B",
+    21: "2B",
+    22: "3B",
+    23: "HR",
+}
 
-def generate_stats(plays: pd.DataFrame):
-    stats = {
-        "PA": 0,
-        "1B": 0,
-        "2B": 0,
-        "3B": 0,
-        "HR": 0,
-        "BB": 0,
-        "HBP": 0,
-        "K": 0,
+
+def count_plays(plays: pd.DataFrame, group: np.ndarray | None = None, num_groups: int = 1) -> dict:
+    """
+    The raw counts behind the stats for one chunk of plays, as whole-column masks rather than a loop over the plays.
+    Every count is an array with one entry per group (group[i] is the group of play i, all plays are in group 0 if
+    it's None), and the counts split by outs have another axis for the outs.
+    """
+    if group is None:
+        group = np.zeros(plays.shape[0], dtype=np.int64)
+    else:
+        group = np.asarray(group, dtype=np.int64)
+    event_code = plays["EVENT_CD"].to_numpy()
+    outs = plays["OUTS_CT"].to_numpy(dtype=np.int64)
+    runner_state_before = plays["START_BASES_CD"].to_numpy()
+    event_outs = plays["EVENT_OUTS_CT"].to_numpy()
+    batted_ball = plays["BATTEDBALL_CD"].to_numpy(dtype=object)
+    ground = batted_ball == "G"
+    fly = batted_ball == "F"
+    line = batted_ball == "L"
+    destination = {
+        "B": plays["BAT_DEST_ID"].to_numpy(),
+        "1B": plays["RUN1_DEST_ID"].to_numpy(),
+        "2B": plays["RUN2_DEST_ID"].to_numpy(),
+        "3B": plays["RUN3_DEST_ID"].to_numpy(),
+    }
+    on = {
+        "1B": (runner_state_before & 0b001) != 0,
+        "2B": (runner_state_before & 0b010) != 0,
+        "3B": (runner_state_before & 0b100) != 0,
     }
+    # Plays with any other event code are ignored
+    event = {name: np.zeros(plays.shape[0], dtype=bool) for name in dict.fromkeys(event_code_to_event.values())}
+    for code, name in event_code_to_event.items():
+        event[name] |= event_code == code
+
+    def count(mask):
+        return np.bincount(group[mask], minlength=num_groups)
+
+    def count_by_outs(mask, num_outs):
+        return np.bincount(group[mask] * num_outs + outs[mask], minlength=num_groups * num_outs).reshape(
+            num_groups, num_outs
+        )
+
+    # Anything but a stolen base or caught stealing is a PA (and errors get counted twice, as a PA and as "PA")
+    plate_appearance = np.zeros(plays.shape[0], dtype=bool)
+    for name in ["1B", "2B", "3B", "HR", "BB", "HBP", "K", "Out", "PA"]:
+        plate_appearance |= event[name]
+    stats = {"PA": count(plate_appearance) + count(event["PA"])}
+    for name in ["1B", "2B", "3B", "HR", "BB", "HBP", "K"]:
+        stats[name] = count(event[name])
 
     # Can use this to see the percent of stolen bases that are of 2nd or third
     sb = {
-        "SB2O": 0,  # Steal second opportunities (runner on first, no runner on second)
-        "SB2": 0,
-        "CS2": 0,
-        "SB3O": 0,  # Steal third opportunities (runner on second, no runner on third)
-        "SB3": 0,
-        "CS3": 0,
+        "SB2O": count(
+            plate_appearance & on["1B"] & ~on["2B"]
+        ),  # Steal second opportunities (runner on first, no runner on second)
+        "SB2": count(event["SB"] & plays["RUN1_SB_FL"].to_numpy()),
+        "CS2": count(event["CS"] & plays["RUN1_CS_FL"].to_numpy()),
+        "SB3O": count(
+            plate_appearance & on["2B"] & ~on["3B"]
+        ),  # Steal third opportunities (runner on second, no runner on third)
+        "SB3": count(event["SB"] & plays["RUN2_SB_FL"].to_numpy()),
+        "CS3": count(event["CS"] & plays["RUN2_CS_FL"].to_numpy()),
     }
 
     # Basically, the outer keys are the type of hit, the next are where the runner starts, and the inner are the number of outs
     # An XBT is when a runner goes more bases than the batter. So, for example, a single with a runner on first and the runner gets to third is an XBT
-    xbt = {
+    # Each entry is (the plays that are a chance, the base the runner has to get to (or past) for an XBT, max outs + 1)
+    out_before_two = event["Out"] & (outs < 2)
+    xbt_plays = {
         "1B": {
-            "1B": [0, 0, 0],
-            "2B": [0, 0, 0],
+            "1B": (event["1B"] & on["1B"], 3, 3),  # Has to be exactly third
+            "2B": (event["1B"] & on["2B"], 4, 3),
         },
         "2B": {
-            "1B": [0, 0, 0],
+            "1B": (event["2B"] & on["1B"], 4, 3),
         },
         "FOut": {
-            "1B": [0, 0],
-            "2B": [0, 0],
-            "3B": [0, 0],
+            "1B": (out_before_two & fly & on["1B"], 2, 2),
+            "2B": (out_before_two & fly & on["2B"], 3, 2),
+            "3B": (out_before_two & fly & on["3B"], 4, 2),
         },
         "GOut": {  # Excludes force plays
-            # "1B": [0, 0],
-            "2B": [0, 0],
-            "3B": [0, 0],
+            "2B": (out_before_two & ground & on["2B"] & ~on["1B"], 3, 2),
+            "3B": (out_before_two & ground & on["3B"] & (~on["2B"] | ~on["1B"]), 4, 2),
         },
-        "LOut": {
-            "1B": [0, 0],
-            "2B": [0, 0],
-            "3B": [0, 0],
+        "LOut": {  # Only the lead runner
+            "1B": (out_before_two & line & on["1B"], 2, 2),
+            "2B": (out_before_two & line & ~on["1B"] & on["2B"], 3, 2),
+            "3B": (out_before_two & line & ~on["1B"] & ~on["2B"] & on["3B"], 4, 2),
         },
     }
+    xbt = {}
+    xbt_chances = {}
+    xbt_thrown_out = {}
+    for hit, bases in xbt_plays.items():
+        xbt[hit] = {}
+        xbt_chances[hit] = {}
+        xbt_thrown_out[hit] = {}
+        for base, (chance, xbt_base, num_outs) in bases.items():
+            if hit == "1B" and base == "1B":
+                extra_base = destination[base] == xbt_base
+            else:
+                extra_base = destination[base] >= xbt_base
+            xbt_chances[hit][base] = count_by_outs(chance, num_outs)
+            xbt[hit][base] = count_by_outs(chance & extra_base, num_outs)
+            xbt_thrown_out[hit][base] = count_by_outs(chance & (destination[base] == 0), num_outs)
 
-    xbt_chances = deepcopy(xbt)
+    # GIDP
+    valid = np.zeros(plays.shape[0], dtype=bool)
+    for mask in event.values():
+        valid |= mask
+    gidp_count = count(valid & ground & plays["DP_FL"].to_numpy())
 
-    xbt_thrown_out = deepcopy(xbt)
-    # If there's a runner on first (or more) and less than two outs
-    gidp_opportunities = 0
-    gidp_opportunities_no_out = 0
-    gidp_count = 0
-    gidp_failure_outs_no_2b = {
-        "B": 0,
-        "1B": 0,
-    }
-    gidp_failure_outs_2b = {
-        "B": 0,
-        "1B": 0,
-        "2B": 0,
-    }
-    gidp_failure_runner_2b_freq = 0
-    gidp_failure_outs_loaded = {
-        "B": 0,
-        "1B": 0,
-        "2B": 0,
-        "3B": 0,
-    }
-    gidp_failure_runner_loaded_freq = 0
-    gidp_failure_1b = 0
-
-    groundout_frequency = 0
-    flyout_frequency = 0
-    lineout_frequency = 0
-
-    event_code_to_event = {
-        2: "Out",
-        3: "K",
-        4: "SB",
-        6: "CS",
-        14: "BB",
-        15: "BB",  # IBB, basically a walk
-        16: "HBP",
-        18: "PA",  # Error, just count it as a PA
-        20: "1B",
-        21: "2B",
-        22: "3B",
-        23: "HR",
+    # If there's a runner on first (or more) and less than two outs, you can GIDP!
+    gidp_chance = valid & ground & (outs < 2) & on["1B"]
+    gidp_failure = gidp_chance & (event_outs == 1)
+
+    def failure_outs(runners):
+        # Who got the one out, checked in this order
+        outs_by_runner = {}
+        not_yet = gidp_failure & (runner_state_before == runners)
+        for runner in ["B", "1B", "2B", "3B"][: bin(runners).count("1") + 1]:
+            outs_by_runner[runner] = count(not_yet & (destination[runner] == 0))
+            not_yet = not_yet & (destination[runner] != 0)
+        return outs_by_runner
+
+    groundout_frequency = count(event["Out"] & ground)
+    flyout_frequency = count(event["Out"] & fly)
+    lineout_frequency = count(event["Out"] & line)
+    return {
+        "stats": stats,
+        "sb": sb,
+        "xbt": xbt,
+        "xbt_chances": xbt_chances,
+        "xbt_thrown_out": xbt_thrown_out,
+        "gidp_opportunities": count(gidp_chance & (event_outs >= 1)),
+        "gidp_count": gidp_count,
+        "gidp_failure_outs_no_2b": failure_outs(0b001),
+        "gidp_failure_outs_2b": failure_outs(0b011),
+        "gidp_failure_runner_2b_freq": count(gidp_failure & (runner_state_before == 0b011)),
+        "gidp_failure_outs_loaded": failure_outs(0b111),
+        "gidp_failure_runner_loaded_freq": count(gidp_failure & (runner_state_before == 0b111)),
+        "gidp_failure_1b": count(gidp_failure & (runner_state_before == 0b001)),
+        "groundout_frequency": groundout_frequency,
+        "flyout_frequency": flyout_frequency,
+        "lineout_frequency": lineout_frequency,
     }
 
-    for _, play in tqdm(plays.iterrows(), total=plays.shape[0]):
-        if play["EVENT_CD"] not in event_code_to_event:
-            continue
-        runner_state_before = int(play["START_BASES_CD"])
-        event = event_code_to_event[int(play["EVENT_CD"])]
-        if event == "Out":
-            stats["PA"] += 1
-            if play["BATTEDBALL_CD"] == "G":
-                groundout_frequency += 1
-            elif play["BATTEDBALL_CD"] == "F":
-                flyout_frequency += 1
-            elif play["BATTEDBALL_CD"] == "L":
-                lineout_frequency += 1
-
-            if int(play["OUTS_CT"]) == 2:
-                pass
-            elif play["BATTEDBALL_CD"] == "F":
-                if runner_state_before & 0b001:
-                    xbt_chances["FOut"]["1B"][int(play["OUTS_CT"])] += 1
-                    if int(play["RUN1_DEST_ID"]) >= 2:
-                        xbt["FOut"]["1B"][int(play["OUTS_CT"])] += 1
-                    if int(play["RUN1_DEST_ID"]) == 0:
-                        xbt_thrown_out["FOut"]["1B"][int(play["OUTS_CT"])] += 1
-                if runner_state_before & 0b010:
-                    xbt_chances["FOut"]["2B"][int(play["OUTS_CT"])] += 1
-                    if int(play["RUN2_DEST_ID"]) >= 3:
-                        xbt["FOut"]["2B"][int(play["OUTS_CT"])] += 1
-                    if int(play["RUN2_DEST_ID"]) == 0:
-                        xbt_thrown_out["FOut"]["2B"][int(play["OUTS_CT"])] += 1
-                if runner_state_before & 0b100:
-                    xbt_chances["FOut"]["3B"][int(play["OUTS_CT"])] += 1
-                    if int(play["RUN3_DEST_ID"]) >= 4:
-                        xbt["FOut"]["3B"][int(play["OUTS_CT"])] += 1
-                    if int(play["RUN3_DEST_ID"]) == 0:
-                        xbt_thrown_out["FOut"]["3B"][int(play["OUTS_CT"])] += 1
-            elif play["BATTEDBALL_CD"] == "G":
-                # if runner_state_before & 0b001:
-                #     xbt_chances["GOut"]["1B"][int(play["OUTS_CT"])] += 1
-                #     if int(play["RUN1_DEST_ID"]) >= 2:
-                #         xbt["GOut"]["1B"][int(play["OUTS_CT"])] += 1
-                #     if int(play["RUN1_DEST_ID"]) == 0:
-                #         xbt_thrown_out["GOut"]["1B"][int(play["OUTS_CT"])] += 1
-
-                # Exclude force plays
-                if runner_state_before & 0b010 and not runner_state_before & 0b001:
-                    xbt_chances["GOut"]["2B"][int(play["OUTS_CT"])] += 1
-                    if int(play["RUN2_DEST_ID"]) >= 3:
-                        xbt["GOut"]["2B"][int(play["OUTS_CT"])] += 1
-                    if int(play["RUN2_DEST_ID"]) == 0:
-                        xbt_thrown_out["GOut"]["2B"][int(play["OUTS_CT"])] += 1
-                if runner_state_before & 0b100 and (not runner_state_before & 0b010 or not runner_state_before & 0b001):
-                    xbt_chances["GOut"]["3B"][int(play["OUTS_CT"])] += 1
-                    if int(play["RUN3_DEST_ID"]) >= 4:
-                        xbt["GOut"]["3B"][int(play["OUTS_CT"])] += 1
-                    if int(play["RUN3_DEST_ID"]) == 0:
-                        xbt_thrown_out["GOut"]["3B"][int(play["OUTS_CT"])] += 1
-            elif play["BATTEDBALL_CD"] == "L":
-                if runner_state_before & 0b001:
-                    xbt_chances["LOut"]["1B"][int(play["OUTS_CT"])] += 1
-                    if int(play["RUN1_DEST_ID"]) >= 2:
-                        xbt["LOut"]["1B"][int(play["OUTS_CT"])] += 1
-                    if int(play["RUN1_DEST_ID"]) == 0:
-                        xbt_thrown_out["LOut"]["1B"][int(play["OUTS_CT"])] += 1
-                elif runner_state_before & 0b010:
-                    xbt_chances["LOut"]["2B"][int(play["OUTS_CT"])] += 1
-                    if int(play["RUN2_DEST_ID"]) >= 3:
-                        xbt["LOut"]["2B"][int(play["OUTS_CT"])] += 1
-                    if int(play["RUN2_DEST_ID"]) == 0:
-                        xbt_thrown_out["LOut"]["2B"][int(play["OUTS_CT"])] += 1
-                elif runner_state_before & 0b100:
-                    xbt_chances["LOut"]["3B"][int(play["OUTS_CT"])] += 1
-                    if int(play["RUN3_DEST_ID"]) >= 4:
-                        xbt["LOut"]["3B"][int(play["OUTS_CT"])] += 1
-                    if int(play["RUN3_DEST_ID"]) == 0:
-                        xbt_thrown_out["LOut"]["3B"][int(play["OUTS_CT"])] += 1
-        elif event == "SB":
-            if play["RUN1_SB_FL"] == "T":
-                sb["SB2"] += 1
-            if play["RUN2_SB_FL"] == "T":
-                sb["SB3"] += 1
-        elif event == "CS":
-            if play["RUN1_CS_FL"] == "T":
-                sb["CS2"] += 1
-            if play["RUN2_CS_FL"] == "T":
-                sb["CS3"] += 1
+
+XBT_LAYOUT = {
+    "1B": {"1B": (3,), "2B": (3,)},
+    "2B": {"1B": (3,)},
+    "FOut": {"1B": (2,), "2B": (2,), "3B": (2,)},
+    "GOut": {"2B": (2,), "3B": (2,)},
+    "LOut": {"1B": (2,), "2B": (2,), "3B": (2,)},
+}
+# The shape of every count in count_plays (leaving out the groups), () for a single number
+STATS_LAYOUT = {
+    "stats": dict.fromkeys(["PA", "1B", "2B", "3B", "HR", "BB", "HBP", "K"], ()),
+    "sb": dict.fromkeys(["SB2O", "SB2", "CS2", "SB3O", "SB3", "CS3"], ()),
+    "xbt": XBT_LAYOUT,
+    "xbt_chances": XBT_LAYOUT,
+    "xbt_thrown_out": XBT_LAYOUT,
+    "gidp_opportunities": (),
+    "gidp_count": (),
+    "gidp_failure_outs_no_2b": dict.fromkeys(["B", "1B"], ()),
+    "gidp_failure_outs_2b": dict.fromkeys(["B", "1B", "2B"], ()),
+    "gidp_failure_runner_2b_freq": (),
+    "gidp_failure_outs_loaded": dict.fromkeys(["B", "1B", "2B", "3B"], ()),
+    "gidp_failure_runner_loaded_freq": (),
+    "gidp_failure_1b": (),
+    "groundout_frequency": (),
+    "flyout_frequency": (),
+    "lineout_frequency": (),
+}
+
+
+def layout_fields(layout, path=()):
+    # The path (the keys to get to it) and shape of every count in layout
+    if isinstance(layout, dict):
+        for key, value in layout.items():
+            yield from layout_fields(value, path + (key,))
+    else:
+        yield path, layout
+
+
+# Where each count goes in StatsCounts.counts
+STATS_FIELDS = {}
+STATS_SIZE = 0
+for path, shape in layout_fields(STATS_LAYOUT):
+    STATS_FIELDS[path] = (slice(STATS_SIZE, STATS_SIZE + int(np.prod(shape))), shape)
+    STATS_SIZE += int(np.prod(shape))
+
+
+def rate(numerator, denominator):
+    # NaN where there's nothing to divide by, instead of a ZeroDivisionError
+    numerator = np.asarray(numerator, dtype=float)
+    denominator = np.asarray(denominator, dtype=float)
+    out = np.full(np.broadcast_shapes(numerator.shape, denominator.shape), np.nan)
+    return np.divide(numerator, denominator, out=out, where=denominator != 0)
+
+
+def nested_tolist(nested):
+    if isinstance(nested, dict):
+        return {key: nested_tolist(value) for key, value in nested.items()}
+    return np.asarray(nested).tolist()
+
+
+class StatsCounts:
+    """
+    The raw counts behind stats.json, all in one int64 array (its last axis is STATS_SIZE long, any axes before that
+    are groups). Counts from different files, years, processes etc. add up with +, and they only get turned into
+    rates by rates(). The counts are only floats after shrink().
+    """
+
+    __slots__ = ("counts",)
+    COLUMNS = STATS_COLUMNS
+
+    def __init__(self, counts=None):
+        counts = np.zeros(STATS_SIZE, dtype=np.int64) if counts is None else np.asarray(counts)
+        self.counts = counts if np.issubdtype(counts.dtype, np.floating) else counts.astype(np.int64)
+
+    def __add__(self, other: "StatsCounts") -> "StatsCounts":
+        return StatsCounts(self.counts + other.counts)
+
+    def __getitem__(self, path: tuple | str) -> np.ndarray:
+        position, shape = STATS_FIELDS[path if isinstance(path, tuple) else (path,)]
+        return self.counts[..., position].reshape(self.counts.shape[:-1] + shape)
+
+    @classmethod
+    def from_plays(cls, plays: pd.DataFrame, group: np.ndarray | None = None, num_groups: int = 1) -> "StatsCounts":
+        """
+        Counts a chunk of plays. With group, there's a row of counts for each of num_groups groups.
+        """
+        nested = count_plays(plays, group, num_groups)
+        counts = np.zeros((num_groups, STATS_SIZE), dtype=np.int64)
+        for path, (position, _) in STATS_FIELDS.items():
+            value = nested
+            for key in path:
+                value = value[key]
+            counts[:, position] = value.reshape(num_groups, -1)
+        return cls(counts[0] if group is None else counts)
+
+    def to_json(self) -> dict:
+        nested: dict = {}
+        for path in STATS_FIELDS:
+            parent = nested
+            for key in path[:-1]:
+                parent = parent.setdefault(key, {})
+            parent[path[-1]] = self[path].tolist()
+        return nested
+
+    @classmethod
+    def from_json(cls, nested: dict) -> "StatsCounts":
+        fields = []
+        for path, (_, shape) in STATS_FIELDS.items():
+            value = nested
+            for key in path:
+                value = value[key]
+            value = np.asarray(value, dtype=np.int64)
+            fields.append(value.reshape(value.shape[: value.ndim - len(shape)] + (-1,)))
+        return cls(np.concatenate(fields, axis=-1))
+
+    def shrink(self, league: "StatsCounts", plate_appearances: float) -> "StatsCounts":
+        """
+        Adds plate_appearances PAs worth of league average counts to the counts (of every group), so the rates from
+        small samples get pulled toward the league average
+        """
+        return StatsCounts(self.counts + league.counts * (plate_appearances / league["stats", "PA"]))
+
+    def rates(self) -> dict:
+        """
+        Everything in stats.json (as arrays with the same axes as the groups, if there are any)
+        """
+        stats = {name: self["stats", name] for name in STATS_LAYOUT["stats"]}
+        stats["Outs"] = (
+            stats["PA"]
+            - stats["1B"]
+            - stats["2B"]
+            - stats["3B"]
+            - stats["HR"]
+            - stats["BB"]
+            - stats["HBP"]
+            - stats["K"]
+        )
+        xbt_attempt_rate = {}
+        xbt_success_rate = {}
+        for hit, bases in XBT_LAYOUT.items():
+            xbt_attempt_rate[hit] = {}
+            xbt_success_rate[hit] = {}
+            for base in bases:
+                xbt = self["xbt", hit, base]
+                thrown_out = self["xbt_thrown_out", hit, base]
+                xbt_attempt_rate[hit][base] = rate(xbt + thrown_out, self["xbt_chances", hit, base])
+                xbt_success_rate[hit][base] = rate(xbt, thrown_out + xbt)
+
+        batted_balls = self["groundout_frequency"] + self["flyout_frequency"] + self["lineout_frequency"]
+        return {
+            "stats": {name: rate(value, stats["PA"]) for name, value in stats.items() if name != "PA"},
+            "sb": {name: self["sb", name] for name in STATS_LAYOUT["sb"]},
+            "xbt_attempt_rate": xbt_attempt_rate,
+            "xbt_success_rate": xbt_success_rate,
+            "gidp_rate": rate(self["gidp_count"], self["gidp_opportunities"]),
+            "groundout_rate": rate(self["groundout_frequency"], batted_balls),
+            "flyout_rate": rate(self["flyout_frequency"], batted_balls),
+            "lineout_rate": rate(self["lineout_frequency"], batted_balls),
+            "gidp_failure_outs": {
+                runner: rate(self["gidp_failure_outs_no_2b", runner], self["gidp_failure_1b"])
+                for runner in STATS_LAYOUT["gidp_failure_outs_no_2b"]
+            },
+            "gidp_failure_outs_2b": {
+                runner: rate(self["gidp_failure_outs_2b", runner], self["gidp_failure_runner_2b_freq"])
+                for runner in STATS_LAYOUT["gidp_failure_outs_2b"]
+            },
+            "gidp_failure_outs_loaded": {
+                runner: rate(self["gidp_failure_outs_loaded", runner], self["gidp_failure_runner_loaded_freq"])
+                for runner in STATS_LAYOUT["gidp_failure_outs_loaded"]
+            },
+        }
+
+
+def count_stats(chunks: Iterable[pd.DataFrame]) -> StatsCounts:
+    """
+    The raw counts behind the stats (not the rates)
+    """
+    return sum((StatsCounts.from_plays(plays) for plays in chunks), StatsCounts())
+
+
+def generate_stats(chunks: Iterable[pd.DataFrame]) -> dict:
+    return count_stats(chunks).rates()
+
+
+def write_stats(counts: StatsCounts, out_file: str):
+    # Anything with nothing to divide by (like GIDP rates with no GIDP chances) is written as NaN
+    with open(out_file, "w") as f:
+        json.dump(nested_tolist(counts.rates()), f, indent=4)
+
+
+def flatten_rates(rates: dict, path: tuple = ()):
+    # Every rate as (name, values for each group), with the keys joined by dots and one column per number of outs
+    for key, value in rates.items():
+        if isinstance(value, dict):
+            yield from flatten_rates(value, path + (key,))
+        elif value.ndim == 1:
+            yield ".".join(path + (key,)), value
         else:
-            stats[event] += 1
-            stats["PA"] += 1
-
-        if event in ["1B", "2B", "3B", "HR", "BB", "HBP", "K", "Out", "PA"]:
-            # 1B is occupied but not 2B
-            if runner_state_before & 0b001 and not runner_state_before & 0b010:
-                sb["SB2O"] += 1
-
-            # 2B is occupied but not 3B
-            if runner_state_before & 0b010 and not runner_state_before & 0b100:
-                sb["SB3O"] += 1
-
-        # Single with a runner on first
-        if event == "1B" and runner_state_before & 0b001:
-            xbt_chances["1B"]["1B"][int(play["OUTS_CT"])] += 1
-            if int(play["RUN1_DEST_ID"]) == 3:
-                xbt["1B"]["1B"][int(play["OUTS_CT"])] += 1
-            if int(play["RUN1_DEST_ID"]) == 0:
-                xbt_thrown_out["1B"]["1B"][int(play["OUTS_CT"])] += 1
-
-        # Single with a runner on second
-        if event == "1B" and runner_state_before & 0b010:
-            xbt_chances["1B"]["2B"][int(play["OUTS_CT"])] += 1
-            if int(play["RUN2_DEST_ID"]) >= 4:
-                xbt["1B"]["2B"][int(play["OUTS_CT"])] += 1
-            if int(play["RUN2_DEST_ID"]) == 0:
-                xbt_thrown_out["1B"]["2B"][int(play["OUTS_CT"])] += 1
-
-        # Double with a runner on first
-        if event == "2B" and runner_state_before & 0b001:
-            xbt_chances["2B"]["1B"][int(play["OUTS_CT"])] += 1
-            if int(play["RUN1_DEST_ID"]) >= 4:
-                xbt["2B"]["1B"][int(play["OUTS_CT"])] += 1
-            if int(play["RUN1_DEST_ID"]) == 0:
-                xbt_thrown_out["2B"]["1B"][int(play["OUTS_CT"])] += 1
-
-        # GIDP
-        if play["BATTEDBALL_CD"] == "G" and play["DP_FL"] == "T":
-            gidp_count += 1
-
-        # If there's a runner on first, you can GIDP!
-        if play["BATTEDBALL_CD"] == "G" and int(play["OUTS_CT"]) < 2 and runner_state_before & 0b001:
-            if int(play["EVENT_OUTS_CT"]) >= 1:
-                gidp_opportunities += 1
-            if int(play["EVENT_OUTS_CT"]) == 1:
-                if runner_state_before == 0b011:
-                    gidp_failure_runner_2b_freq += 1
-                    if int(play["BAT_DEST_ID"]) == 0:
-                        gidp_failure_outs_2b["B"] += 1
-                    elif int(play["RUN1_DEST_ID"]) == 0:
-                        gidp_failure_outs_2b["1B"] += 1
-                    elif int(play["RUN2_DEST_ID"]) == 0:
-                        gidp_failure_outs_2b["2B"] += 1
-                elif runner_state_before == 0b001:
-                    gidp_failure_1b += 1
-                    if int(play["BAT_DEST_ID"]) == 0:
-                        gidp_failure_outs_no_2b["B"] += 1
-                    elif int(play["RUN1_DEST_ID"]) == 0:
-                        gidp_failure_outs_no_2b["1B"] += 1
-                elif runner_state_before == 0b111:
-                    gidp_failure_runner_loaded_freq += 1
-                    if int(play["BAT_DEST_ID"]) == 0:
-                        gidp_failure_outs_loaded["B"] += 1
-                    elif int(play["RUN1_DEST_ID"]) == 0:
-                        gidp_failure_outs_loaded["1B"] += 1
-                    elif int(play["RUN2_DEST_ID"]) == 0:
-                        gidp_failure_outs_loaded["2B"] += 1
-                    elif int(play["RUN3_DEST_ID"]) == 0:
-                        gidp_failure_outs_loaded["3B"] += 1
-
-    xbt_attempt_rate = deepcopy(xbt)
-    xbt_succcess_rate = deepcopy(xbt)
-    for key in xbt:
-        for key2 in xbt[key]:
-            for idx, value in enumerate(xbt[key][key2]):
-                xbt_attempt_rate[key][key2][idx] = (xbt[key][key2][idx] + xbt_thrown_out[key][key2][idx]) / xbt_chances[
-                    key
-                ][key2][idx]
-                xbt_succcess_rate[key][key2][idx] = xbt[key][key2][idx] / (
-                    xbt_thrown_out[key][key2][idx] + xbt[key][key2][idx]
-                )
-
-    stats["Outs"] = (
-        stats["PA"] - stats["1B"] - stats["2B"] - stats["3B"] - stats["HR"] - stats["BB"] - stats["HBP"] - stats["K"]
-    )
-    weighted_stats = {}
-    for key, value in stats.items():
-        if key != "PA":
-            weighted_stats[key] = value / stats["PA"]
-    gidp_failure_outs_no_2b = {
-        "B": gidp_failure_outs_no_2b["B"] / gidp_failure_1b,
-        "1B": gidp_failure_outs_no_2b["1B"] / gidp_failure_1b,
-    }
-    gidp_failure_outs_2b = {
-        "B": gidp_failure_outs_2b["B"] / gidp_failure_runner_2b_freq,
-        "1B": gidp_failure_outs_2b["1B"] / gidp_failure_runner_2b_freq,
-        "2B": gidp_failure_outs_2b["2B"] / gidp_failure_runner_2b_freq,
-    }
-    gidp_failure_outs_loaded = {
-        "B": gidp_failure_outs_loaded["B"] / gidp_failure_runner_loaded_freq,
-        "1B": gidp_failure_outs_loaded["1B"] / gidp_failure_runner_loaded_freq,
-        "2B": gidp_failure_outs_loaded["2B"] / gidp_failure_runner_loaded_freq,
-        "3B": gidp_failure_outs_loaded["3B"] / gidp_failure_runner_loaded_freq,
-    }
-    return (
-        weighted_stats,
-        sb,
-        xbt_attempt_rate,
-        xbt_succcess_rate,
-        gidp_count / gidp_opportunities,
-        groundout_frequency / (groundout_frequency + flyout_frequency + lineout_frequency),
-        flyout_frequency / (groundout_frequency + flyout_frequency + lineout_frequency),
-        lineout_frequency / (groundout_frequency + flyout_frequency + lineout_frequency),
-        gidp_failure_outs_no_2b,
-        gidp_failure_outs_2b,
-        gidp_failure_outs_loaded,
-    )
+            for outs in range(value.shape[1]):
+                yield ".".join(path + (key, str(outs))), value[:, outs]
+
+
+def write_player_stats(players: GroupedCounts, out_file: str, format: str, shrinkage: float = 0):
+    """
+    One row per batter with their PAs and everything in stats.json (flattened into columns)
+    """
+    players = players.sorted()
+    counts = players.totals()
+    if shrinkage > 0:
+        counts = counts.shrink(StatsCounts(counts.counts.sum(axis=0)), shrinkage)
+    table = {"player": [player for (player,) in players.groups], "PA": players.totals()["stats", "PA"]}
+    table.update(flatten_rates(counts.rates()))
+    write_table(pd.DataFrame(table), out_file, format)
 
 
 def main(start_year: int, end_year: int):
     parser = argparse.ArgumentParser()
-    parser.add_argument("--out-file", "-o", help="Output file", type=str, default="stats.json")
+    parser.add_argument(
+        "--out-file", "-o", help="Output file (stats.json, or player_stats.<format> with --per-player)", type=str
+    )
+    parser.add_argument("--jobs", "-j", help="Number of processes to count the files with", type=int, default=1)
+    parser.add_argument(
+        "--per-player", "-p", help="Make a table of the stats of every batter instead", action="store_true"
+    )
+    parser.add_argument(
+        "--format",
+        help="Output format for --per-player. npy is a NumPy structured array that can be memory-mapped",
+        choices=["csv", "parquet", "npy"],
+        default="npy",
+    )
+    parser.add_argument(
+        "--shrinkage",
+        help="With --per-player, pull every batter toward league average by adding this many PAs of league "
+        "average stats",
+        type=float,
+        default=0,
+    )
     args = parser.parse_args(sys.argv[1:])
-    if start_year > end_year:
-        print("START_YEAR must be less than END_YEAR", file=sys.stderr)
-        sys.exit(1)
-    elif start_year < start_data_year or end_year > end_data_year:
-        print(
-            f"START_YEAR and END_YEAR must be between {start_data_year} and {end_data_year}. If {end_data_year + 1} or a future year has been added to retrosheet, feel free to edit this file.",
-            file=sys.stderr,
-        )
-        sys.exit(1)
+    files = data_files(start_year, end_year)
+    if not args.per_player:
+        counts = cached_counts({"stats": StatsCounts()}, files, args.jobs)
+        write_stats(sum(counts["stats"], StatsCounts()), args.out_file or "stats.json")
+        return
 
-    if not os.path.isdir("data"):
-        print(
-            "The folder data doesn't exist. Have you run retrosheet_to_csv.sh?",
-            file=sys.stderr,
-        )
-        sys.exit(1)
-    files = sorted(os.listdir("data"))
-    if not len(files):
-        print(
-            "The folder data doesn't have any files. Have you run retrosheet_to_csv.sh?",
-            file=sys.stderr,
-        )
-        sys.exit(1)
-
-    files_filtered = []
-    for file in files:
-        if int(file[0:4]) < start_year or int(file[0:4]) > end_year:  # type: ignore
-            continue
-        else:
-            files_filtered.append(file)  # type: ignore
-    years = []
-
-    for idx, file in enumerate(tqdm(files_filtered)):  # type: ignore
-        if int(file[0:4]) < start_year or int(file[0:4]) > end_year:  # type: ignore
-            continue
-        file = "data/" + file  # type: ignore
-        reader = pd.read_csv(  # type: ignore
-            file,  # type: ignore
-        )
-        years.append(reader)  # type: ignore
-        del reader
-    plays = pd.concat(years)  # type: ignore
-    del years
-    (
-        stats,
-        sb,
-        xbt_attempt_rate,
-        xbt_succcess_rate,
-        gidp_rate,
-        groundout_rate,
-        flyout_rate,
-        lineout_rate,
-        gidp_failure_outs,
-        gidp_failure_outs_2b,
-        gidp_failure_outs_loaded,
-    ) = generate_stats(plays)
-    with open(args.out_file, "w") as f:
-        json.dump(
-            {
-                "stats": stats,
-                "sb": sb,
-                "xbt_attempt_rate": xbt_attempt_rate,
-                "xbt_success_rate": xbt_succcess_rate,
-                "gidp_rate": gidp_rate,
-                "groundout_rate": groundout_rate,
-                "flyout_rate": flyout_rate,
-                "lineout_rate": lineout_rate,
-                "gidp_failure_outs": gidp_failure_outs,
-                "gidp_failure_outs_2b": gidp_failure_outs_2b,
-                "gidp_failure_outs_loaded": gidp_failure_outs_loaded,
-            },
-            f,
-            indent=4,
-        )
+    empty = GroupedCounts(StatsCounts, ["batter"])
+    counts = cached_counts({"stats_by_batter": empty}, files, args.jobs)
+    write_player_stats(
+        sum(counts["stats_by_batter"], empty),
+        args.out_file or f"player_stats.{args.format}",
+        args.format,
+        args.shrinkage,
+    )
 
 
 if __name__ == "__main__":
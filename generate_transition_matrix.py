@@ -1,14 +1,27 @@
+import argparse
 import csv
 import os
 import sys
+from typing import Iterable, Iterator
 
+import numpy as np
 import pandas as pd
-from tqdm import tqdm
+from numpy import random
 
 from config import end_data_year, start_data_year
+from plays import (
+    GROUP_BY_COLUMNS,
+    TRANSITION_COLUMNS,
+    GroupedCounts,
+    cached_counts,
+    data_files,
+    files_by_year,
+)
 
 
-def generate_transition_matrix(plays: pd.DataFrame) -> list[list[float]]:
+def count_transitions(
+    plays: pd.DataFrame, group: np.ndarray | None = None, num_groups: int = 1
+) -> np.ndarray:
     # We want base-out states to be the initial states and base-out states
     # along with the number of runs scored (as well as a final inning over state) to be the columns
     # Base state = 0b000 for bases empty, 0b001 for runner on first, 0b010 for runner on second, 0b100 for runner on third, etc
@@ -25,83 +38,247 @@ def generate_transition_matrix(plays: pd.DataFrame) -> list[list[float]]:
     # equivalent_start_state (losing the encoding of the runs) = end_state // 5
     # outs = equivalent_start_state // 8
     # base_state = equivalent_start_state % 8
-    transition_frequency_count = [[0 for _ in range(124)] for _ in range(24)]
-    for _, play in tqdm(
-        plays.iterrows(), total=plays.shape[0], desc="Generating transition matrix"
-    ):
-        base_state_start = int(play["START_BASES_CD"])
-        base_state_end = int(play["END_BASES_CD"])
-        start_outs = int(play["OUTS_CT"])
-        end_outs = start_outs + int(play["EVENT_OUTS_CT"])
-        runs = int(play["EVENT_RUNS_CT"])
-
-        if end_outs == 3:
-            base_state_end = 0
-
-        start_state_index = start_outs * 8 + base_state_start
-        end_state_index = (end_outs * 8 + base_state_end) * 5 + runs
-        transition_frequency_count[start_state_index][end_state_index] += 1
-
-    transition_matrix = [[0 for _ in range(124)] for _ in range(24)]
-    for start_state_index in range(24):
-        s = sum(transition_frequency_count[start_state_index])
-        for end_state_index in range(124):
-            transition_matrix[start_state_index][end_state_index] = (
-                transition_frequency_count[start_state_index][end_state_index] / s
-            )
-        assert 0.999999 < sum(transition_matrix[start_state_index]) < 1.000001
-    return transition_matrix
+    start_outs = plays["OUTS_CT"].to_numpy(dtype=np.int64)
+    end_outs = start_outs + plays["EVENT_OUTS_CT"].to_numpy(dtype=np.int64)
+    runs = plays["EVENT_RUNS_CT"].to_numpy(dtype=np.int64)
+    base_state_start = plays["START_BASES_CD"].to_numpy(dtype=np.int64)
+    base_state_end = np.where(
+        end_outs == 3, 0, plays["END_BASES_CD"].to_numpy(dtype=np.int64)
+    )
 
+    start_state_index = start_outs * 8 + base_state_start
+    end_state_index = (end_outs * 8 + base_state_end) * 5 + runs
+    if group is None:
+        return np.bincount(
+            start_state_index * 124 + end_state_index, minlength=24 * 124
+        ).reshape(24, 124)
+    # One 24x124 block of counts for each group
+    group = np.asarray(group, dtype=np.int64)
+    return np.bincount(
+        (group * 24 + start_state_index) * 124 + end_state_index,
+        minlength=num_groups * 24 * 124,
+    ).reshape(num_groups, 24, 124)
 
-def main(start_year: int, end_year: int):
-    if start_year > end_year:
-        print("START_YEAR must be less than END_YEAR", file=sys.stderr)
-        sys.exit(1)
-    elif start_year < start_data_year or end_year > end_data_year:
-        print(
-            f"START_YEAR and END_YEAR must be between {start_data_year} and {end_data_year}. If {end_data_year + 1} or a future year has been added to retrosheet, feel free to edit this file.",
-            file=sys.stderr,
-        )
-        sys.exit(1)
 
-    if not os.path.isdir("data"):
-        print(
-            "The folder data doesn't exist. Have you run retrosheet_to_csv.sh?",
-            file=sys.stderr,
-        )
-        sys.exit(1)
-    files = sorted(os.listdir("data"))
-    if not len(files):
-        print(
-            "The folder data doesn't have any files. Have you run retrosheet_to_csv.sh?",
-            file=sys.stderr,
-        )
-        sys.exit(1)
-
-    files_filtered = []
-    for file in files:
-        if int(file[0:4]) < start_year or int(file[0:4]) > end_year:  # type: ignore
-            continue
-        else:
-            files_filtered.append(file)  # type: ignore
-    years = []
-
-    for idx, file in enumerate(tqdm(files_filtered)):  # type: ignore
-        if int(file[0:4]) < start_year or int(file[0:4]) > end_year:  # type: ignore
-            continue
-        file = "data/" + file  # type: ignore
-        reader = pd.read_csv(  # type: ignore
-            file,  # type: ignore
+class TransitionCounts:
+    """
+    How many times each transition (row and column of the transition matrix) happened,
+    as an int64 array (with any axes before the last two being groups). Counts add up
+    with +, and only get turned into probabilities by matrix().
+    """
+
+    __slots__ = ("counts",)
+    COLUMNS = TRANSITION_COLUMNS
+
+    def __init__(self, counts=None):
+        self.counts = (
+            np.zeros((24, 124), dtype=np.int64)
+            if counts is None
+            else np.asarray(counts, dtype=np.int64)
         )
-        years.append(reader)  # type: ignore
-        del reader
-    plays = pd.concat(years)  # type: ignore
-    del years
-    matrix = generate_transition_matrix(plays)
-    with open("transition_matrix.csv", "w") as f:
+
+    def __add__(self, other: "TransitionCounts") -> "TransitionCounts":
+        return TransitionCounts(self.counts + other.counts)
+
+    @classmethod
+    def from_plays(
+        cls, plays: pd.DataFrame, group: np.ndarray | None = None, num_groups: int = 1
+    ) -> "TransitionCounts":
+        return cls(count_transitions(plays, group, num_groups))
+
+    def to_json(self) -> list:
+        return self.counts.tolist()
+
+    @classmethod
+    def from_json(cls, counts: list) -> "TransitionCounts":
+        return cls(counts)
+
+    def matrix(self) -> np.ndarray:
+        # Rows for states that never came up are NaN instead of dividing by zero
+        totals = self.counts.sum(axis=-1, keepdims=True)
+        matrix = np.full(self.counts.shape, np.nan)
+        return np.divide(self.counts, totals, out=matrix, where=totals != 0)
+
+
+def generate_transition_matrix(counts: TransitionCounts) -> list[list[float]]:
+    transition_matrix = counts.matrix()
+    totals = transition_matrix.sum(axis=-1)
+    assert np.all(np.isnan(totals) | ((0.999999 < totals) & (totals < 1.000001)))
+    return transition_matrix.tolist()
+
+
+def write_transition_matrix(counts: TransitionCounts, out_file: str):
+    matrix = generate_transition_matrix(counts)
+    with open(out_file, "w") as f:
         w = csv.writer(f)
         w.writerows(matrix)
 
 
+def write_grouped_transition_matrices(
+    counts: GroupedCounts, out_file: str, split_dir: str | None = None
+):
+    counts = counts.sorted()
+    matrices = counts.totals().matrix()
+    groups = np.array(counts.groups, dtype=str).reshape(
+        len(counts.groups), len(counts.group_by)
+    )
+    np.savez_compressed(
+        out_file,
+        group_by=np.array(counts.group_by),
+        groups=groups,
+        matrices=matrices,
+        counts=counts.counts,
+    )
+    if split_dir is not None:
+        # The CSVs are for simulate_game.py, which needs every row. States that never
+        # came up in a group get the row of everyone put together instead.
+        pooled = TransitionCounts(counts.counts.sum(axis=0)).matrix()
+        unseen = np.isnan(matrices).any(axis=-1)
+        filled = np.where(unseen[..., None], pooled, matrices)
+        os.makedirs(split_dir, exist_ok=True)
+        for group, matrix in zip(counts.groups, filled):
+            file = os.path.join(split_dir, f"transition_matrix_{'_'.join(group)}.csv")
+            with open(file, "w") as f:
+                w = csv.writer(f)
+                w.writerows(matrix.tolist())
+
+
+def game_counts_by_year(files: list[str], jobs: int = 1) -> Iterator[GroupedCounts]:
+    """
+    The counts of every game in files, one GroupedCounts per year (from the cache when
+    it's there). Each year is counted or loaded when it's needed, so only one year of
+    per-game counts is in memory at a time instead of every year at once.
+    """
+    empty = GroupedCounts(TransitionCounts, ["game"])
+    for _, year_files in sorted(files_by_year(files).items()):
+        counts = cached_counts({"transitions_by_game": empty}, year_files, jobs)
+        # Sorted, since the order the games were counted in depends on --jobs and the
+        # resampling has to go through them in the same order for --seed to work
+        yield counts["transitions_by_game"][0].sorted()
+
+
+def bootstrap_transition_counts(
+    games: Iterable[GroupedCounts], num_samples: int, rng, chunk_size: int = 4096
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Resamples games num_samples times and returns the transition counts of each sample,
+    as an array of shape (num_samples, 24, 124), and the counts of all the games. games
+    is the counts of every game (split up however, like one GroupedCounts per year) and
+    only gets gone through once. Each game gets a Poisson(1) weight in each sample, so a
+    sample is just the weights times the per-game counts.
+    """
+    totals = np.zeros((num_samples, 24 * 124))
+    all_games = np.zeros((24, 124), dtype=np.int64)
+    for counts in games:
+        all_games += counts.counts.sum(axis=0)
+        per_game = counts.counts.reshape(len(counts.groups), 24 * 124)
+        for start in range(0, per_game.shape[0], chunk_size):
+            chunk = per_game[start : start + chunk_size].astype(float)
+            weights = rng.poisson(1, size=(num_samples, chunk.shape[0])).astype(float)
+            totals += weights @ chunk
+    return totals.reshape(num_samples, 24, 124), all_games
+
+
+def write_bootstrap(
+    games: Iterable[GroupedCounts],
+    num_samples: int,
+    confidence: float,
+    rng,
+    out_file: str,
+):
+    samples, all_games = bootstrap_transition_counts(games, num_samples, rng)
+    samples = TransitionCounts(samples).matrix()
+    matrix = TransitionCounts(all_games)
+    tail = (1 - confidence) / 2 * 100
+    # A state can come up zero times in a sample, those samples are left out for that row
+    np.savez_compressed(
+        out_file,
+        matrix=matrix.matrix(),
+        mean=np.nanmean(samples, axis=0),
+        std=np.nanstd(samples, axis=0),
+        lower=np.nanpercentile(samples, tail, axis=0),
+        upper=np.nanpercentile(samples, 100 - tail, axis=0),
+        confidence=confidence,
+        num_samples=num_samples,
+    )
+
+
+def main(start_year: int, end_year: int):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        help="Number of processes to count the files with",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--group-by",
+        "-g",
+        help="Make a transition matrix for every combination of these",
+        nargs="+",
+        choices=list(GROUP_BY_COLUMNS),
+    )
+    parser.add_argument(
+        "--out-file",
+        "-o",
+        help="Output file (transition_matrix.csv, or .npz with --group-by/--bootstrap)",
+        type=str,
+    )
+    parser.add_argument(
+        "--split-dir",
+        help="With --group-by, also write each group's matrix as a CSV in this folder",
+        type=str,
+    )
+    parser.add_argument(
+        "--bootstrap",
+        "-b",
+        help="Resample games this many times and write the mean, standard deviation "
+        "and percentile interval of every entry of the matrix",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--confidence",
+        help="Width of the --bootstrap percentile interval",
+        type=float,
+        default=0.95,
+    )
+    parser.add_argument(
+        "--seed", "-s", help="Random seed for --bootstrap", type=int, default=None
+    )
+    args = parser.parse_args(sys.argv[1:])
+    files = data_files(start_year, end_year)
+    if args.bootstrap > 0:
+        if args.group_by is not None:
+            print("--bootstrap doesn't work with --group-by", file=sys.stderr)
+            sys.exit(1)
+        write_bootstrap(
+            game_counts_by_year(files, args.jobs),
+            args.bootstrap,
+            args.confidence,
+            random.default_rng(args.seed),
+            args.out_file or "transition_matrix_bootstrap.npz",
+        )
+        return
+
+    if args.group_by is None:
+        counts = cached_counts({"transitions": TransitionCounts()}, files, args.jobs)
+        write_transition_matrix(
+            sum(counts["transitions"], TransitionCounts()),
+            args.out_file or "transition_matrix.csv",
+        )
+        return
+
+    name = "transitions_by_" + "_".join(args.group_by)
+    empty = GroupedCounts(TransitionCounts, args.group_by)
+    counts = cached_counts({name: empty}, files, args.jobs)
+    write_grouped_transition_matrices(
+        sum(counts[name], empty),
+        args.out_file or "transition_matrices.npz",
+        args.split_dir,
+    )
+
+
 if __name__ == "__main__":
     main(start_data_year, end_data_year)
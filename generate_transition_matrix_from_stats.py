@@ -1,408 +1,398 @@
 import argparse
 import csv
 import json
+import os
 import random
 import sys
+import time
+from collections import defaultdict
+from concurrent.futures import as_completed
 
+import numpy as np
 from tqdm import tqdm
 
+from plays import process_pool
+from stats_plan import DOUBLE, FIRST, FLYOUT, GROUNDOUT, LINEOUT, SECOND, SINGLE, THIRD, Choice, StatsPlan
 
-def generate_transition_matrix(stats: dict) -> list[list[float]]:
+# Bump this whenever play() changes, so matrices cached by matrix_cache.py are made again
+MATRIX_VERSION = 1
+
+
+def play(plan: StatsPlan, outs: int, base_state: int, chance, choice) -> tuple[int, int, int]:
     """
-    Using Monte Carlo simulation to estimate the transition matrix
+    One plate appearance (or steal attempt) starting with outs and base_state. Every random decision goes through
+    chance(p) (True with probability p) or choice(c) for a Choice c, so the same play can be sampled or have every way
+    it can go walked through. Returns the new outs, base state and runs scored.
     """
-    transition_matrix = [[0 for _ in range(124)] for _ in range(24)]
-    for state in tqdm(range(24), desc="States", position=0, leave=True):
-        outs = state // 8
-        base_state = state % 8
-        for _ in tqdm(range(1_000_000), desc="Simulations", position=1, leave=False):
-            # for _ in range(1):
-            new_state = base_state
-            new_outs = outs
-            runs_scored = 0
-            sb2_opportunity = new_state & 0b001 and not new_state & 0b010
-            sb3_opportunity = new_state & 0b010 and not new_state & 0b100
-            assert not (sb2_opportunity and sb3_opportunity)
-            # If the runner on first tries to steal second
-            if sb2_opportunity and random.random() < (stats["sb"]["SB2"] + stats["sb"]["CS2"]) / stats["sb"]["SB2O"]:
-                if random.random() < stats["sb"]["CS2"] / (stats["sb"]["SB2"] + stats["sb"]["CS2"]):
-                    # remove the runner on first
-                    new_state &= 0b110
-                    new_outs += 1
-                else:
-                    new_state |= 0b010
-                    new_state &= 0b110
-            # If the runner on second tries to steal third
-            elif sb3_opportunity and random.random() < (stats["sb"]["SB3"] + stats["sb"]["CS3"]) / stats["sb"]["SB3O"]:
-                if random.random() < stats["sb"]["CS3"] / (stats["sb"]["SB3"] + stats["sb"]["CS3"]):
-                    # remove the runner on second
-                    new_state &= 0b101
-                    new_outs += 1
-                else:
-                    new_state |= 0b100
-                    new_state &= 0b101
-            else:
-                event = random.choices(list(stats["stats"].keys()), weights=stats["stats"].values(), k=1)[0]
-                if event in ("HBP", "BB"):
-                    match base_state:
-                        case 0b000:
-                            new_state = 0b001
-                        case 0b001:
-                            new_state = 0b011
-                        case 0b010:
-                            new_state = 0b011
-                        case 0b011:
-                            new_state = 0b111
-                        case 0b100:
-                            new_state = 0b101
-                        case 0b101:
-                            new_state = 0b111
-                        case 0b110:
-                            new_state = 0b111
-                        case 0b111:
-                            new_state = 0b1111
-                    if new_state & 0b1000:
-                        runs_scored += 1
-                        new_state &= 0b111
-                elif event == "K":
-                    new_outs += 1
-                elif event == "Outs":
-                    new_outs += 1
-                    type_out_choice = random.choices(
-                        ["G", "F", "L"],
-                        weights=[
-                            stats["groundout_rate"],
-                            stats["flyout_rate"],
-                            stats["lineout_rate"],
-                        ],
-                        k=1,
-                    )[0]
-
-                    # Flyout or lineout
-                    if type_out_choice in "FL" and new_outs < 3:
-                        # Scenarios with no runners forcing others
-                        if base_state in [0b101, 0b100, 0b010, 0b001]:
-                            if (
-                                base_state & 0b001
-                                and random.random() < stats["xbt_attempt_rate"][f"{type_out_choice}Out"]["1B"][outs]
-                            ):
-                                if random.random() < stats["xbt_success_rate"][f"{type_out_choice}Out"]["1B"][outs]:
-                                    new_state |= 0b010
-                                    new_state &= 0b110
-                                else:
-                                    new_outs += 1
-                                    new_state &= 0b110
-                            if (
-                                base_state & 0b010
-                                and random.random() < stats["xbt_attempt_rate"][f"{type_out_choice}Out"]["2B"][outs]
-                            ):
-                                if random.random() < stats["xbt_success_rate"][f"{type_out_choice}Out"]["2B"][outs]:
-                                    new_state |= 0b100
-                                    new_state &= 0b101
-                                else:
-                                    new_outs += 1
-                                    new_state &= 0b101
-                            if (
-                                base_state & 0b100
-                                and random.random() < stats["xbt_attempt_rate"][f"{type_out_choice}Out"]["3B"][outs]
-                            ):
-                                if random.random() < stats["xbt_success_rate"][f"{type_out_choice}Out"]["3B"][outs]:
-                                    runs_scored += 1
-                                    new_state &= 0b011
-                                else:
-                                    new_outs += 1
-                                    new_state &= 0b011
-                        # Scenarios with runners forcing others. NOTE: this makes the incorrect assumption that runner advances are independent of each other
-                        elif base_state == 0b011:
-                            # If the runner from first advances and forces the runner from second to third
-                            if random.random() < stats["xbt_attempt_rate"][f"{type_out_choice}Out"]["1B"][outs]:
-                                if random.random() < stats["xbt_success_rate"][f"{type_out_choice}Out"]["2B"][outs]:
-                                    new_state |= 0b100
-                                    new_state &= 0b101
-                                else:
-                                    new_outs += 1
-                                    new_state &= 0b101
-                                if random.random() < stats["xbt_success_rate"][f"{type_out_choice}Out"]["1B"][outs]:
-                                    new_state |= 0b010
-                                    new_state &= 0b110
-                                else:
-                                    new_outs += 1
-                                    new_state &= 0b110
-                            elif random.random() < stats["xbt_attempt_rate"][f"{type_out_choice}Out"]["2B"][outs]:
-                                if random.random() < stats["xbt_success_rate"][f"{type_out_choice}Out"]["2B"][outs]:
-                                    new_state |= 0b100
-                                    new_state &= 0b101
-                                else:
-                                    new_outs += 1
-                                    new_state &= 0b101
-                        elif base_state == 0b110:
-                            # If the runner from second forces the runner at third
-                            if random.random() < stats["xbt_attempt_rate"][f"{type_out_choice}Out"]["2B"][outs]:
-                                if random.random() < stats["xbt_success_rate"][f"{type_out_choice}Out"]["3B"][outs]:
-                                    runs_scored += 1
-                                    new_state &= 0b011
-                                else:
-                                    new_outs += 1
-                                    new_state &= 0b011
-                                if random.random() < stats["xbt_success_rate"][f"{type_out_choice}Out"]["2B"][outs]:
-                                    new_state |= 0b100
-                                    new_state &= 0b101
-                                else:
-                                    new_outs += 1
-                                    new_state &= 0b101
-                            elif random.random() < stats["xbt_attempt_rate"][f"{type_out_choice}Out"]["3B"][outs]:
-                                if random.random() < stats["xbt_success_rate"][f"{type_out_choice}Out"]["3B"][outs]:
-                                    runs_scored += 1
-                                    new_state &= 0b011
-                                else:
-                                    new_outs += 1
-                                    new_state &= 0b011
-                        elif base_state == 0b111:
-                            # If the runner from first forces everyone
-                            if random.random() < stats["xbt_attempt_rate"][f"{type_out_choice}Out"]["1B"][outs]:
-                                if random.random() < stats["xbt_success_rate"][f"{type_out_choice}Out"]["3B"][outs]:
-                                    runs_scored += 1
-                                    new_state &= 0b011
-                                else:
-                                    new_outs += 1
-                                    new_state &= 0b011
-                                if random.random() < stats["xbt_success_rate"][f"{type_out_choice}Out"]["2B"][outs]:
-                                    new_state |= 0b100
-                                    new_state &= 0b101
-                                else:
-                                    new_outs += 1
-                                    new_state &= 0b101
-                                if random.random() < stats["xbt_success_rate"][f"{type_out_choice}Out"]["1B"][outs]:
-                                    new_state |= 0b010
-                                    new_state &= 0b110
-                                else:
-                                    new_outs += 1
-                                    new_state &= 0b110
-                            # If the runner from second forces the runner at third
-                            elif random.random() < stats["xbt_attempt_rate"][f"{type_out_choice}Out"]["2B"][outs]:
-                                if random.random() < stats["xbt_success_rate"][f"{type_out_choice}Out"]["3B"][outs]:
-                                    runs_scored += 1
-                                    new_state &= 0b011
-                                else:
-                                    new_outs += 1
-                                    new_state &= 0b011
-                                if random.random() < stats["xbt_success_rate"][f"{type_out_choice}Out"]["2B"][outs]:
-                                    new_state |= 0b100
-                                    new_state &= 0b101
-                                else:
-                                    new_outs += 1
-                                    new_state &= 0b101
-                            elif random.random() < stats["xbt_attempt_rate"][f"{type_out_choice}Out"]["3B"][outs]:
-                                if random.random() < stats["xbt_success_rate"][f"{type_out_choice}Out"]["3B"][outs]:
-                                    runs_scored += 1
-                                    new_state &= 0b011
-                                else:
-                                    new_outs += 1
-                                    new_state &= 0b011
-                    elif type_out_choice == "G":
-                        # Advance forced runners
-                        match base_state:
-                            case 0b000:
-                                new_state = 0b000
-                            case 0b001:
-                                new_state = 0b010
-                            case 0b010:
-                                new_state = 0b010
-                                if outs < 2 and random.random() < stats["xbt_attempt_rate"]["GOut"]["2B"][outs]:
-                                    if random.random() < stats["xbt_success_rate"]["GOut"]["2B"][outs]:
-                                        new_state = 0b100
-                                    else:
-                                        new_outs += 1
-                                        new_state = 0b000
-                            case 0b011:
-                                new_state = 0b110
-                            case 0b100:
+    new_state = base_state
+    new_outs = outs
+    runs_scored = 0
+    sb2_opportunity = new_state & 0b001 and not new_state & 0b010
+    sb3_opportunity = new_state & 0b010 and not new_state & 0b100
+    assert not (sb2_opportunity and sb3_opportunity)
+    # If the runner on first tries to steal second
+    if sb2_opportunity and chance(plan.steal_attempt[0]):
+        if chance(plan.steal_caught[0]):
+            # remove the runner on first
+            new_state &= 0b110
+            new_outs += 1
+        else:
+            new_state |= 0b010
+            new_state &= 0b110
+    # If the runner on second tries to steal third
+    elif sb3_opportunity and chance(plan.steal_attempt[1]):
+        if chance(plan.steal_caught[1]):
+            # remove the runner on second
+            new_state &= 0b101
+            new_outs += 1
+        else:
+            new_state |= 0b100
+            new_state &= 0b101
+    else:
+        event = choice(plan.events)
+        if event in ("HBP", "BB"):
+            match base_state:
+                case 0b000:
+                    new_state = 0b001
+                case 0b001:
+                    new_state = 0b011
+                case 0b010:
+                    new_state = 0b011
+                case 0b011:
+                    new_state = 0b111
+                case 0b100:
+                    new_state = 0b101
+                case 0b101:
+                    new_state = 0b111
+                case 0b110:
+                    new_state = 0b111
+                case 0b111:
+                    new_state = 0b1111
+            if new_state & 0b1000:
+                runs_scored += 1
+                new_state &= 0b111
+        elif event == "K":
+            new_outs += 1
+        elif event == "Outs":
+            new_outs += 1
+            out_type = choice(plan.out_types)
+
+            # Flyout or lineout
+            if out_type in (FLYOUT, LINEOUT) and new_outs < 3:
+                # Scenarios with no runners forcing others
+                if base_state in [0b101, 0b100, 0b010, 0b001]:
+                    if base_state & 0b001 and chance(plan.xbt_attempt[out_type, FIRST, outs]):
+                        if chance(plan.xbt_success[out_type, FIRST, outs]):
+                            new_state |= 0b010
+                            new_state &= 0b110
+                        else:
+                            new_outs += 1
+                            new_state &= 0b110
+                    if base_state & 0b010 and chance(plan.xbt_attempt[out_type, SECOND, outs]):
+                        if chance(plan.xbt_success[out_type, SECOND, outs]):
+                            new_state |= 0b100
+                            new_state &= 0b101
+                        else:
+                            new_outs += 1
+                            new_state &= 0b101
+                    if base_state & 0b100 and chance(plan.xbt_attempt[out_type, THIRD, outs]):
+                        if chance(plan.xbt_success[out_type, THIRD, outs]):
+                            runs_scored += 1
+                            new_state &= 0b011
+                        else:
+                            new_outs += 1
+                            new_state &= 0b011
+                # Scenarios with runners forcing others. NOTE: this makes the incorrect assumption that runner advances are independent of each other
+                elif base_state == 0b011:
+                    # If the runner from first advances and forces the runner from second to third
+                    if chance(plan.xbt_attempt[out_type, FIRST, outs]):
+                        if chance(plan.xbt_success[out_type, SECOND, outs]):
+                            new_state |= 0b100
+                            new_state &= 0b101
+                        else:
+                            new_outs += 1
+                            new_state &= 0b101
+                        if chance(plan.xbt_success[out_type, FIRST, outs]):
+                            new_state |= 0b010
+                            new_state &= 0b110
+                        else:
+                            new_outs += 1
+                            new_state &= 0b110
+                    elif chance(plan.xbt_attempt[out_type, SECOND, outs]):
+                        if chance(plan.xbt_success[out_type, SECOND, outs]):
+                            new_state |= 0b100
+                            new_state &= 0b101
+                        else:
+                            new_outs += 1
+                            new_state &= 0b101
+                elif base_state == 0b110:
+                    # If the runner from second forces the runner at third
+                    if chance(plan.xbt_attempt[out_type, SECOND, outs]):
+                        if chance(plan.xbt_success[out_type, THIRD, outs]):
+                            runs_scored += 1
+                            new_state &= 0b011
+                        else:
+                            new_outs += 1
+                            new_state &= 0b011
+                        if chance(plan.xbt_success[out_type, SECOND, outs]):
+                            new_state |= 0b100
+                            new_state &= 0b101
+                        else:
+                            new_outs += 1
+                            new_state &= 0b101
+                    elif chance(plan.xbt_attempt[out_type, THIRD, outs]):
+                        if chance(plan.xbt_success[out_type, THIRD, outs]):
+                            runs_scored += 1
+                            new_state &= 0b011
+                        else:
+                            new_outs += 1
+                            new_state &= 0b011
+                elif base_state == 0b111:
+                    # If the runner from first forces everyone
+                    if chance(plan.xbt_attempt[out_type, FIRST, outs]):
+                        if chance(plan.xbt_success[out_type, THIRD, outs]):
+                            runs_scored += 1
+                            new_state &= 0b011
+                        else:
+                            new_outs += 1
+                            new_state &= 0b011
+                        if chance(plan.xbt_success[out_type, SECOND, outs]):
+                            new_state |= 0b100
+                            new_state &= 0b101
+                        else:
+                            new_outs += 1
+                            new_state &= 0b101
+                        if chance(plan.xbt_success[out_type, FIRST, outs]):
+                            new_state |= 0b010
+                            new_state &= 0b110
+                        else:
+                            new_outs += 1
+                            new_state &= 0b110
+                    # If the runner from second forces the runner at third
+                    elif chance(plan.xbt_attempt[out_type, SECOND, outs]):
+                        if chance(plan.xbt_success[out_type, THIRD, outs]):
+                            runs_scored += 1
+                            new_state &= 0b011
+                        else:
+                            new_outs += 1
+                            new_state &= 0b011
+                        if chance(plan.xbt_success[out_type, SECOND, outs]):
+                            new_state |= 0b100
+                            new_state &= 0b101
+                        else:
+                            new_outs += 1
+                            new_state &= 0b101
+                    elif chance(plan.xbt_attempt[out_type, THIRD, outs]):
+                        if chance(plan.xbt_success[out_type, THIRD, outs]):
+                            runs_scored += 1
+                            new_state &= 0b011
+                        else:
+                            new_outs += 1
+                            new_state &= 0b011
+            elif out_type == GROUNDOUT:
+                # Advance forced runners
+                match base_state:
+                    case 0b000:
+                        new_state = 0b000
+                    case 0b001:
+                        new_state = 0b010
+                    case 0b010:
+                        new_state = 0b010
+                        if outs < 2 and chance(plan.xbt_attempt[GROUNDOUT, SECOND, outs]):
+                            if chance(plan.xbt_success[GROUNDOUT, SECOND, outs]):
                                 new_state = 0b100
-                                if outs < 2 and random.random() < stats["xbt_attempt_rate"]["GOut"]["3B"][outs]:
-                                    if random.random() < stats["xbt_success_rate"]["GOut"]["3B"][outs]:
-                                        new_state = 0b000
-                                        if new_outs < 3:
-                                            runs_scored += 1
-                                    else:
-                                        new_outs += 1
-                                        new_state = 0b000
-                            case 0b101:
-                                new_state = 0b110
-                                if outs < 2 and random.random() < stats["xbt_attempt_rate"]["GOut"]["3B"][outs]:
-                                    if random.random() < stats["xbt_success_rate"]["GOut"]["3B"][outs]:
-                                        new_state = 0b010
-                                        if new_outs < 3:
-                                            runs_scored += 1
-                                    else:
-                                        new_outs += 1
-                                        new_state = 0b010
-                            case 0b110:
-                                new_state = 0b110
-                                if outs < 2 and random.random() < stats["xbt_attempt_rate"]["GOut"]["2B"][outs]:
-                                    if random.random() < stats["xbt_success_rate"]["GOut"]["3B"][outs]:
-                                        new_state = 0b010
-                                        if new_outs < 3:
-                                            runs_scored += 1
-                                    else:
-                                        new_outs += 1
-                                        new_state = 0b010
-                                    if random.random() < stats["xbt_success_rate"]["GOut"]["2B"][outs]:
-                                        new_state = 0b100
-                                    else:
-                                        new_outs += 1
-                                        new_state = 0b000
-                                elif outs < 2 and random.random() < stats["xbt_attempt_rate"]["GOut"]["3B"][outs]:
-                                    if random.random() < stats["xbt_success_rate"]["GOut"]["3B"][outs]:
-                                        new_state = 0b010
-                                        if new_outs < 3:
-                                            runs_scored += 1
-                                    else:
-                                        new_outs += 1
-                                        new_state = 0b010
-                            case 0b111:
-                                new_state = 0b1111
-
-                        if base_state == 0b001 or base_state == 0b101:
-                            if random.random() < stats["gidp_rate"]:
+                            else:
                                 new_outs += 1
-                                new_state &= 0b100
-                                # new_state <<= 1
-                                if new_state & 0b1000 and new_outs < 3:
+                                new_state = 0b000
+                    case 0b011:
+                        new_state = 0b110
+                    case 0b100:
+                        new_state = 0b100
+                        if outs < 2 and chance(plan.xbt_attempt[GROUNDOUT, THIRD, outs]):
+                            if chance(plan.xbt_success[GROUNDOUT, THIRD, outs]):
+                                new_state = 0b000
+                                if new_outs < 3:
                                     runs_scored += 1
-                                new_state &= 0b111
                             else:
-                                if random.random() > stats["gidp_failure_outs"]["B"]:
-                                    new_state &= 0b101
-                                    new_state |= 0b001
-                        elif base_state == 0b011:
-                            if random.random() < stats["gidp_rate"]:
                                 new_outs += 1
-                                new_state &= 0b100
+                                new_state = 0b000
+                    case 0b101:
+                        new_state = 0b110
+                        if outs < 2 and chance(plan.xbt_attempt[GROUNDOUT, THIRD, outs]):
+                            if chance(plan.xbt_success[GROUNDOUT, THIRD, outs]):
+                                new_state = 0b010
+                                if new_outs < 3:
+                                    runs_scored += 1
                             else:
-                                base = random.choices(
-                                    ["B", "1B", "2B"],
-                                    weights=[
-                                        stats["gidp_failure_outs_2b"]["B"],
-                                        stats["gidp_failure_outs_2b"]["1B"],
-                                        stats["gidp_failure_outs_2b"]["2B"],
-                                    ],
-                                    k=1,
-                                )[0]
-                                if base == "B":
-                                    new_state &= 0b110
-                                elif base == "1B":
-                                    new_state &= 0b101
-                                elif base == "2B":
-                                    new_state &= 0b011
-                        elif base_state == 0b111:
-                            if random.random() < stats["gidp_rate"]:
                                 new_outs += 1
-                                new_state = 0b100
+                                new_state = 0b010
+                    case 0b110:
+                        new_state = 0b110
+                        if outs < 2 and chance(plan.xbt_attempt[GROUNDOUT, SECOND, outs]):
+                            if chance(plan.xbt_success[GROUNDOUT, THIRD, outs]):
+                                new_state = 0b010
                                 if new_outs < 3:
                                     runs_scored += 1
-                            else:
-                                base = random.choices(
-                                    ["B", "1B", "2B", "3B"],
-                                    weights=[
-                                        stats["gidp_failure_outs_loaded"]["B"],
-                                        stats["gidp_failure_outs_loaded"]["1B"],
-                                        stats["gidp_failure_outs_loaded"]["2B"],
-                                        stats["gidp_failure_outs_loaded"]["3B"],
-                                    ],
-                                    k=1,
-                                )[0]
-                                if base == "B":
-                                    new_state &= 0b110
-                                    if new_outs < 3:
-                                        runs_scored += 1
-                                elif base == "1B":
-                                    new_state &= 0b101
-                                    if new_outs < 3:
-                                        runs_scored += 1
-                                elif base == "2B":
-                                    new_state &= 0b011
-                                    if new_outs < 3:
-                                        runs_scored += 1
-                                elif base == "3B":
-                                    new_state &= 0b111
-                        elif base_state == 0b110 or base_state == 0b100 or base_state == 0b010 or base_state == 0b000:
-                            if new_state & 0b1000 and new_outs < 3:
-                                runs_scored += 1
-                            new_state &= 0b111
-                        if new_outs >= 3:
-                            runs_scored = 0
-
-                elif event == "HR":
-                    runs_scored += 1 + bin(base_state).count("1")
-                    new_state = 0
-                elif event == "3B":
-                    runs_scored += bin(base_state).count("1")
-                    new_state = 0b100
-                elif event == "2B":
-                    new_state <<= 2
-                    runs_scored += bin(new_state >> 3).count("1")
-                    new_state &= 0b111
-                    new_state |= 0b010
-                    if new_state == 0b110:
-                        if random.random() < stats["xbt_attempt_rate"]["2B"]["1B"][outs]:
-                            if random.random() < stats["xbt_success_rate"]["2B"]["1B"][outs]:
-                                new_state &= 0b011
-                                runs_scored += 1
                             else:
                                 new_outs += 1
-                                new_state &= 0b011
-                elif event == "1B":
-                    new_state <<= 1
-                    runs_scored += bin(new_state >> 3).count("1")
-                    new_state &= 0b111
-                    new_state |= 0b001
-                    if new_state == 0b111:
-                        if random.random() < stats["xbt_attempt_rate"]["1B"]["1B"][outs]:
-                            if random.random() < stats["xbt_success_rate"]["1B"]["2B"][outs]:
-                                new_state &= 0b011
-                                runs_scored += 1
+                                new_state = 0b010
+                            if chance(plan.xbt_success[GROUNDOUT, SECOND, outs]):
+                                new_state = 0b100
                             else:
                                 new_outs += 1
-                                new_state &= 0b011
-                            if random.random() < stats["xbt_success_rate"]["1B"]["1B"][outs]:
-                                new_state &= 0b101
-                                new_state |= 0b100
+                                new_state = 0b000
+                        elif outs < 2 and chance(plan.xbt_attempt[GROUNDOUT, THIRD, outs]):
+                            if chance(plan.xbt_success[GROUNDOUT, THIRD, outs]):
+                                new_state = 0b010
+                                if new_outs < 3:
+                                    runs_scored += 1
                             else:
                                 new_outs += 1
-                                new_state &= 0b101
-                        elif random.random() < stats["xbt_attempt_rate"]["1B"]["2B"][outs]:
-                            if random.random() < stats["xbt_success_rate"]["1B"]["2B"][outs]:
-                                new_state &= 0b011
+                                new_state = 0b010
+                    case 0b111:
+                        new_state = 0b1111
+
+                if base_state == 0b001 or base_state == 0b101:
+                    if chance(plan.gidp_rate):
+                        new_outs += 1
+                        new_state &= 0b100
+                        # new_state <<= 1
+                        if new_state & 0b1000 and new_outs < 3:
+                            runs_scored += 1
+                        new_state &= 0b111
+                    else:
+                        if not chance(plan.gidp_failure_outs):
+                            new_state &= 0b101
+                            new_state |= 0b001
+                elif base_state == 0b011:
+                    if chance(plan.gidp_rate):
+                        new_outs += 1
+                        new_state &= 0b100
+                    else:
+                        base = choice(plan.gidp_failure_2b)
+                        if base == "B":
+                            new_state &= 0b110
+                        elif base == "1B":
+                            new_state &= 0b101
+                        elif base == "2B":
+                            new_state &= 0b011
+                elif base_state == 0b111:
+                    if chance(plan.gidp_rate):
+                        new_outs += 1
+                        new_state = 0b100
+                        if new_outs < 3:
+                            runs_scored += 1
+                    else:
+                        base = choice(plan.gidp_failure_loaded)
+                        if base == "B":
+                            new_state &= 0b110
+                            if new_outs < 3:
                                 runs_scored += 1
-                            else:
-                                new_outs += 1
-                                new_state &= 0b011
-                    elif new_state == 0b011:
-                        if random.random() < stats["xbt_attempt_rate"]["1B"]["1B"][outs]:
-                            if random.random() < stats["xbt_success_rate"]["1B"]["1B"][outs]:
-                                new_state &= 0b101
-                                new_state |= 0b100
-                            else:
-                                new_outs += 1
-                                new_state &= 0b101
-                    elif new_state == 0b101:
-                        if random.random() < stats["xbt_attempt_rate"]["1B"]["2B"][outs]:
-                            if random.random() < stats["xbt_success_rate"]["1B"]["2B"][outs]:
-                                new_state &= 0b011
+                        elif base == "1B":
+                            new_state &= 0b101
+                            if new_outs < 3:
                                 runs_scored += 1
-                            else:
-                                new_outs += 1
-                                new_state &= 0b011
-                else:
-                    raise ValueError(f"Unknown event {event}")
-            if new_outs >= 3:
-                new_outs = 3
-                new_state = 0
+                        elif base == "2B":
+                            new_state &= 0b011
+                            if new_outs < 3:
+                                runs_scored += 1
+                        elif base == "3B":
+                            new_state &= 0b111
+                elif base_state == 0b110 or base_state == 0b100 or base_state == 0b010 or base_state == 0b000:
+                    if new_state & 0b1000 and new_outs < 3:
+                        runs_scored += 1
+                    new_state &= 0b111
+                if new_outs >= 3:
+                    runs_scored = 0
+
+        elif event == "HR":
+            runs_scored += 1 + bin(base_state).count("1")
+            new_state = 0
+        elif event == "3B":
+            runs_scored += bin(base_state).count("1")
+            new_state = 0b100
+        elif event == "2B":
+            new_state <<= 2
+            runs_scored += bin(new_state >> 3).count("1")
+            new_state &= 0b111
+            new_state |= 0b010
+            if new_state == 0b110:
+                if chance(plan.xbt_attempt[DOUBLE, FIRST, outs]):
+                    if chance(plan.xbt_success[DOUBLE, FIRST, outs]):
+                        new_state &= 0b011
+                        runs_scored += 1
+                    else:
+                        new_outs += 1
+                        new_state &= 0b011
+        elif event == "1B":
+            new_state <<= 1
+            runs_scored += bin(new_state >> 3).count("1")
+            new_state &= 0b111
+            new_state |= 0b001
+            if new_state == 0b111:
+                if chance(plan.xbt_attempt[SINGLE, FIRST, outs]):
+                    if chance(plan.xbt_success[SINGLE, SECOND, outs]):
+                        new_state &= 0b011
+                        runs_scored += 1
+                    else:
+                        new_outs += 1
+                        new_state &= 0b011
+                    if chance(plan.xbt_success[SINGLE, FIRST, outs]):
+                        new_state &= 0b101
+                        new_state |= 0b100
+                    else:
+                        new_outs += 1
+                        new_state &= 0b101
+                elif chance(plan.xbt_attempt[SINGLE, SECOND, outs]):
+                    if chance(plan.xbt_success[SINGLE, SECOND, outs]):
+                        new_state &= 0b011
+                        runs_scored += 1
+                    else:
+                        new_outs += 1
+                        new_state &= 0b011
+            elif new_state == 0b011:
+                if chance(plan.xbt_attempt[SINGLE, FIRST, outs]):
+                    if chance(plan.xbt_success[SINGLE, FIRST, outs]):
+                        new_state &= 0b101
+                        new_state |= 0b100
+                    else:
+                        new_outs += 1
+                        new_state &= 0b101
+            elif new_state == 0b101:
+                if chance(plan.xbt_attempt[SINGLE, SECOND, outs]):
+                    if chance(plan.xbt_success[SINGLE, SECOND, outs]):
+                        new_state &= 0b011
+                        runs_scored += 1
+                    else:
+                        new_outs += 1
+                        new_state &= 0b011
+        else:
+            raise ValueError(f"Unknown event {event}")
+    if new_outs >= 3:
+        new_outs = 3
+        new_state = 0
+    return new_outs, new_state, runs_scored
+
+
+def generate_transition_matrix(plan: StatsPlan, num_its: int = 1_000_000, progress: bool = True) -> list[list[float]]:
+    """
+    Using Monte Carlo simulation to estimate the transition matrix
+    """
+
+    def chance(p):
+        return random.random() < p
+
+    def choice(c: Choice):
+        return random.choices(c.keys, cum_weights=c.cumulative, k=1)[0]
+
+    transition_matrix = [[0 for _ in range(124)] for _ in range(24)]
+    for state in tqdm(range(24), desc="States", position=0, leave=True, disable=not progress):
+        outs = state // 8
+        base_state = state % 8
+        for _ in tqdm(range(num_its), desc="Simulations", position=1, leave=False, disable=not progress):
+            new_outs, new_state, runs_scored = play(plan, outs, base_state, chance, choice)
             new_full_state = (new_outs * 8 + new_state) * 5 + runs_scored
             transition_matrix[state][new_full_state] += 1
-            # print(
-            #     f"Event: {event}, Old state: {state}, old runners {bin(base_state)}, New runners: {bin(new_state)}, old outs: {outs}, New outs: {new_outs}, Runs scored: {runs_scored}, New full state: {new_full_state}"
-            # )
     for state in range(24):
         s = sum(transition_matrix[state])
         for new_state in range(124):
@@ -411,16 +401,211 @@ def generate_transition_matrix(stats: dict) -> list[list[float]]:
     return transition_matrix
 
 
+def play_outcomes(plan: StatsPlan, outs: int, base_state: int, split, amount) -> dict[tuple[int, int, int], float]:
+    """
+    Every way play() can go, found one path (list of branches taken) at a time. Each path carries an amount (a
+    probability, or a number of plays) that split(weights, amount) divides up between the branches of every decision
+    past the end of the path, as (branch, amount) pairs. The first one is followed and the rest are queued up as new
+    paths to play again. Returns the total amount for each (new outs, new base state, runs scored).
+    """
+    outcomes: dict[tuple[int, int, int], float] = defaultdict(float)
+    paths: list[tuple[list[int], float]] = [([], amount)]
+    while paths:
+        path, amount = paths.pop()
+        decisions = 0
+
+        def decide(weights) -> int:
+            nonlocal decisions, amount
+            if decisions == len(path):
+                branches = split(weights, amount)
+                for branch, branch_amount in branches[1:]:
+                    paths.append((path + [branch], branch_amount))
+                path.append(branches[0][0])
+                amount = branches[0][1]
+            branch = path[decisions]
+            decisions += 1
+            return branch
+
+        def chance(p):
+            return decide([p, 1 - p]) == 0
+
+        def choice(c: Choice):
+            return c.keys[decide(c.probabilities)]
+
+        outcomes[play(plan, outs, base_state, chance, choice)] += amount
+    return outcomes
+
+
+def exact_transition_matrix(plan: StatsPlan) -> list[list[float]]:
+    """
+    The exact transition matrix, adding up the probability of every way each play can go instead of sampling
+    """
+
+    def split(weights, probability):
+        return [(branch, probability * weight) for branch, weight in enumerate(weights) if weight > 0]
+
+    transition_matrix = [[0.0 for _ in range(124)] for _ in range(24)]
+    for state in range(24):
+        outcomes = play_outcomes(plan, state // 8, state % 8, split, 1.0)
+        for (new_outs, new_state, runs_scored), probability in outcomes.items():
+            transition_matrix[state][(new_outs * 8 + new_state) * 5 + runs_scored] += probability
+        assert 0.999999 < sum(transition_matrix[state]) < 1.000001
+    return transition_matrix
+
+
+def sampled_transition_matrix(plan: StatsPlan, num_its: int, rng: np.random.Generator) -> list[list[float]]:
+    """
+    Samples num_its plays from each state like generate_transition_matrix, but a whole batch of plays goes down each
+    path at once. At every decision one multinomial draw splits the plays between the branches, which is the same as
+    deciding each play on its own, so only the paths some play actually took ever get played.
+    """
+
+    def split(weights, plays):
+        counts = rng.multinomial(plays, weights)
+        return [(branch, count) for branch, count in enumerate(counts.tolist()) if count > 0]
+
+    counts = np.zeros((24, 124), dtype=np.int64)
+    for state in range(24):
+        outcomes = play_outcomes(plan, state // 8, state % 8, split, num_its)
+        new_full_states = [
+            (new_outs * 8 + new_state) * 5 + runs_scored for new_outs, new_state, runs_scored in outcomes
+        ]
+        counts[state] = np.bincount(new_full_states, weights=list(outcomes.values()), minlength=124)
+    transition_matrix = counts / counts.sum(axis=1, keepdims=True)
+    assert np.allclose(transition_matrix.sum(axis=1), 1)
+    return transition_matrix.tolist()
+
+
+def transition_matrix_for(
+    plan: StatsPlan, backend: str, num_its: int, seed: int | None, progress: bool = True
+) -> list[list[float]]:
+    if backend == "exact":
+        return exact_transition_matrix(plan)
+    elif backend == "sampled":
+        return sampled_transition_matrix(plan, num_its, np.random.default_rng(seed))
+    random.seed(seed)
+    return generate_transition_matrix(plan, num_its, progress)
+
+
+def read_profiles(path: str) -> list[tuple[str, dict]]:
+    """
+    Stats profiles from either a directory of stats files (named after the files) or a JSON lines file with one
+    profile per line (named after their "name" key, or their line number if they don't have one)
+    """
+    profiles = []
+    if os.path.isdir(path):
+        for file in sorted(os.listdir(path)):
+            if file.endswith(".json"):
+                with open(os.path.join(path, file)) as f:
+                    profiles.append((file.removesuffix(".json"), json.load(f)))
+    else:
+        with open(path) as f:
+            for line_number, line in enumerate(f, 1):
+                if line.strip():
+                    stats = json.loads(line)
+                    profiles.append((str(stats.pop("name", line_number)), stats))
+    return profiles
+
+
+def write_batch(
+    profiles: list[tuple[str, dict]], backend: str, num_its: int, seed: int | None, jobs: int, out_file: str
+):
+    """
+    Makes a transition matrix for every profile and saves them stacked in one (profiles, 24, 124) array, along with
+    the profile names, to out_file
+    """
+    names = [name for name, _ in profiles]
+    if len(set(names)) != len(names):
+        print("Every profile needs a different name", file=sys.stderr)
+        sys.exit(1)
+    # Check every profile before making any matrices so a typo in the last one doesn't waste the whole batch
+    plans = []
+    for name, stats in profiles:
+        try:
+            plans.append(StatsPlan(stats))
+        except ValueError as e:
+            print(f"{name}: {e}", file=sys.stderr)
+            sys.exit(1)
+    # Each profile gets its own seed so the batch comes out the same no matter which process makes which matrix
+    seeds = np.random.SeedSequence(seed).generate_state(len(plans)).tolist()
+
+    matrices = np.zeros((len(plans), 24, 124))
+    start = time.perf_counter()
+    if jobs > 1:
+        with process_pool(jobs) as executor:
+            futures = {
+                executor.submit(transition_matrix_for, plan, backend, num_its, profile_seed, False): index
+                for index, (plan, profile_seed) in enumerate(zip(plans, seeds))
+            }
+            for future in tqdm(as_completed(futures), total=len(plans), desc="Profiles", unit="profile"):
+                matrices[futures[future]] = future.result()
+    else:
+        for index in tqdm(range(len(plans)), desc="Profiles", unit="profile"):
+            matrices[index] = transition_matrix_for(plans[index], backend, num_its, seeds[index], False)
+    elapsed = time.perf_counter() - start
+
+    np.savez_compressed(out_file, names=np.array(names, dtype=str), matrices=matrices)
+    print(f"{len(plans)} profiles in {elapsed:.1f}s ({len(plans) / elapsed:,.1f} profiles/sec), saved to {out_file}")
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--stat-file", "-f", help="Stats file", type=str, default="stats.json")
-    parser.add_argument("--out-file", "-o", help="Output file", type=str, default="transition_matrix_custom.csv")
+    parser.add_argument(
+        "--out-file",
+        "-o",
+        help="Output file (by default transition_matrix_custom.csv, or transition_matrices_custom.npz with --batch)",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--backend",
+        "-b",
+        help="exact adds up every way each play can go, sampled and monte-carlo sample plays from each state (sampled "
+        "a batch at a time, monte-carlo one at a time)",
+        choices=["exact", "sampled", "monte-carlo"],
+        default="exact",
+    )
+    parser.add_argument("--num-its", "-n", help="Plays to sample from each state", type=int, default=1_000_000)
+    parser.add_argument("--seed", "-s", help="Random seed for sampling", type=int, default=None)
+    parser.add_argument(
+        "--batch",
+        help="Directory of stats files or JSON lines file of stats profiles to make a matrix for each of (instead of "
+        "--stat-file)",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--jobs", "-j", help="Number of processes to make the batch's matrices with", type=int, default=1
+    )
+    parser.add_argument(
+        "--no-cache", help="Make the matrix again even if it's in cache/matrices/", action="store_true", default=False
+    )
     args = parser.parse_args(sys.argv[1:])
+
+    if args.batch is not None:
+        profiles = read_profiles(args.batch)
+        if not profiles:
+            print(f"There aren't any stats profiles in {args.batch}", file=sys.stderr)
+            sys.exit(1)
+        out_file = args.out_file or "transition_matrices_custom.npz"
+        write_batch(profiles, args.backend, args.num_its, args.seed, args.jobs, out_file)
+        return
+
+    # Imported here since matrix_cache.py imports this file
+    from matrix_cache import cached_transition_matrix
+
     with open(args.stat_file) as f:
         stats = json.load(f)
-
-    transition_matrix = generate_transition_matrix(stats)
-    with open(args.out_file, "w") as f:
+    try:
+        if args.no_cache:
+            transition_matrix = transition_matrix_for(StatsPlan(stats), args.backend, args.num_its, args.seed)
+        else:
+            transition_matrix = cached_transition_matrix(stats, args.backend, args.num_its, args.seed).tolist()
+    except ValueError as e:
+        print(f"{args.stat_file}: {e}", file=sys.stderr)
+        sys.exit(1)
+    with open(args.out_file or "transition_matrix_custom.csv", "w") as f:
         w = csv.writer(f)
         w.writerows(transition_matrix)
 
@@ -0,0 +1,35 @@
+import argparse
+import sys
+
+from config import end_data_year, start_data_year
+from gen_stats_and_bsr import StatsCounts, write_stats
+from generate_transition_matrix import TransitionCounts, write_transition_matrix
+from plays import cached_counts, data_files
+
+# Everything that can be made from the plays in one pass: an empty accumulator to count it (see count_files in
+# plays.py), how to write the output from the counts, and the default output file
+ACCUMULATORS = {
+    "transitions": (TransitionCounts(), write_transition_matrix, "transition_matrix.csv"),
+    "stats": (StatsCounts(), write_stats, "stats.json"),
+}
+
+
+def main(start_year: int, end_year: int):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--only", help="Only make these outputs", nargs="+", choices=list(ACCUMULATORS), default=list(ACCUMULATORS)
+    )
+    for name, (_, _, default_out_file) in ACCUMULATORS.items():
+        parser.add_argument(f"--{name}-file", help=f"Output file for {name}", type=str, default=default_out_file)
+    parser.add_argument("--jobs", "-j", help="Number of processes to count the files with", type=int, default=1)
+    args = parser.parse_args(sys.argv[1:])
+
+    files = data_files(start_year, end_year)
+    counts = cached_counts({name: ACCUMULATORS[name][0] for name in args.only}, files, args.jobs)
+    for name in args.only:
+        accumulator, write, _ = ACCUMULATORS[name]
+        write(sum(counts[name], accumulator), getattr(args, f"{name}_file"))
+
+
+if __name__ == "__main__":
+    main(start_data_year, end_data_year)
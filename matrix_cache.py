@@ -0,0 +1,71 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from generate_transition_matrix_from_stats import MATRIX_VERSION, transition_matrix_for
+from plays import CACHE_DIR, atomic_write
+from stats_plan import StatsPlan
+
+# Matrices made from stats files, one .npy file each named after the hash of what went into it
+MATRIX_CACHE_DIR = os.path.join(CACHE_DIR, "matrices")
+# The least recently used matrices get thrown out once the cache is bigger than this (about 4,000 matrices)
+MATRIX_CACHE_SIZE = 100_000_000
+
+
+def matrix_key(stats: dict, backend: str, num_its: int, seed: int | None) -> str:
+    """
+    Hash of the stats (so the formatting and key order of the file don't matter) and everything else the matrix
+    depends on
+    """
+    if backend == "exact":
+        num_its = seed = None
+    key = {"version": MATRIX_VERSION, "stats": stats, "backend": backend, "num_its": num_its, "seed": seed}
+    return hashlib.sha256(json.dumps(key, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+def evict(max_size: int):
+    """
+    Deletes the least recently used matrices until the cache is at most max_size bytes
+    """
+    entries = []
+    for file in os.listdir(MATRIX_CACHE_DIR):
+        if file.endswith(".npy"):
+            stat = os.stat(os.path.join(MATRIX_CACHE_DIR, file))
+            entries.append((stat.st_mtime_ns, stat.st_size, file))
+    size = sum(entry_size for _, entry_size, _ in entries)
+    for _, entry_size, file in sorted(entries):
+        if size <= max_size:
+            break
+        os.remove(os.path.join(MATRIX_CACHE_DIR, file))
+        size -= entry_size
+
+
+def cached_transition_matrix(
+    stats: dict,
+    backend: str = "exact",
+    num_its: int = 1_000_000,
+    seed: int | None = None,
+    max_size: int = MATRIX_CACHE_SIZE,
+) -> np.ndarray:
+    """
+    The transition matrix for stats from the cache, or made with transition_matrix_for and saved in the cache if it
+    isn't there. Sampling without a seed gives a different matrix every time, so that doesn't use the cache. Raises
+    ValueError for stats that aren't valid (see StatsPlan).
+    """
+    if backend != "exact" and seed is None:
+        return np.array(transition_matrix_for(StatsPlan(stats), backend, num_its, seed))
+
+    os.makedirs(MATRIX_CACHE_DIR, exist_ok=True)
+    cache_file = os.path.join(MATRIX_CACHE_DIR, matrix_key(stats, backend, num_its, seed) + ".npy")
+    if os.path.exists(cache_file):
+        # The modification time is when it was last used, for evict
+        os.utime(cache_file)
+        return np.load(cache_file)
+
+    matrix = np.array(transition_matrix_for(StatsPlan(stats), backend, num_its, seed))
+    with atomic_write(cache_file, "wb") as f:
+        np.save(f, matrix)
+    evict(max_size)
+    return matrix
@@ -0,0 +1,105 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from config import end_data_year, start_data_year
+from plays import (
+    GROUP_COLUMNS,
+    PACKED_DIR,
+    PACKED_VERSION,
+    STATS_COLUMNS,
+    TRANSITION_COLUMNS,
+    atomic_write,
+    data_files,
+    files_by_year,
+    packed_entry,
+    packed_index,
+    read_csv_plays,
+)
+
+# Every column any of the scripts read
+PACKED_COLUMNS = {**TRANSITION_COLUMNS, **STATS_COLUMNS, **GROUP_COLUMNS}
+
+
+def pack_year(year: int, files: list[str]) -> tuple[dict, dict]:
+    """
+    Packs one year of files into packed/<year>/, one .npy file per column. Returns the index entries for the year
+    and for each of its files.
+    """
+    parts: dict[str, list[np.ndarray]] = {column: [] for column in PACKED_COLUMNS}
+    file_entries = {}
+    rows = 0
+    for file in files:
+        file_rows = 0
+        for chunk in read_csv_plays(file, PACKED_COLUMNS):
+            for column, dtype in PACKED_COLUMNS.items():
+                parts[column].append(chunk[column].to_numpy(dtype=object if dtype == "category" else None))
+            file_rows += chunk.shape[0]
+        file_entries[os.path.basename(file)] = {
+            "year": str(year),
+            "size": os.stat(file).st_size,
+            "mtime_ns": os.stat(file).st_mtime_ns,
+            "start": rows,
+            "stop": rows + file_rows,
+        }
+        rows += file_rows
+
+    year_dir = os.path.join(PACKED_DIR, str(year))
+    shutil.rmtree(year_dir, ignore_errors=True)
+    os.makedirs(year_dir)
+    # Categories (like the batted ball type) are saved as their codes, the categories themselves go in the index
+    categories = {}
+    for column, dtype in PACKED_COLUMNS.items():
+        values = np.concatenate(parts[column])
+        if dtype == "category":
+            categorical = pd.Categorical(values)
+            categories[column] = categorical.categories.tolist()
+            values = categorical.codes
+        np.save(os.path.join(year_dir, column + ".npy"), values)
+    return {"rows": rows, "categories": categories}, file_entries
+
+
+def write_index(index: dict):
+    with atomic_write(os.path.join(PACKED_DIR, "index.json")) as f:
+        json.dump(index, f)
+
+
+def main(start_year: int, end_year: int):
+    files = data_files(start_year, end_year)
+    index = packed_index()
+    if index is None or index["columns"] != PACKED_COLUMNS:
+        index = {"version": PACKED_VERSION, "columns": PACKED_COLUMNS, "years": {}, "files": {}}
+
+    os.makedirs(PACKED_DIR, exist_ok=True)
+    for year, year_files in tqdm(files_by_year(files).items()):
+        names = {os.path.basename(file) for file in year_files}
+        packed_names = {name for name, entry in index["files"].items() if entry["year"] == str(year)}
+        if names == packed_names and all(packed_entry(index, file, PACKED_COLUMNS) for file in year_files):
+            continue
+
+        if packed_names:
+            # Take the year out of the index before its arrays get deleted, so if this gets killed halfway its files
+            # are just read from the CSVs instead of from missing or half written arrays
+            index["years"].pop(str(year), None)
+            for name in packed_names:
+                del index["files"][name]
+            write_index(index)
+        index["years"][str(year)], file_entries = pack_year(year, year_files)
+        index["files"].update(file_entries)
+        write_index(index)
+
+    csv_size = sum(os.stat(file).st_size for file in files)
+    packed_size = sum(
+        os.stat(os.path.join(root, file)).st_size
+        for root, _, packed_files in os.walk(PACKED_DIR)
+        for file in packed_files
+    )
+    print(f"{csv_size / 1e6:,.1f} MB of CSV packed into {packed_size / 1e6:,.1f} MB in {PACKED_DIR}/")
+
+
+if __name__ == "__main__":
+    main(start_data_year, end_data_year)
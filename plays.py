@@ -0,0 +1,386 @@
+import json
+import os
+import signal
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import IO, Callable, Iterable, Iterator
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from config import end_data_year, start_data_year
+
+# Only the columns the scripts use, in the narrowest dtype that fits. The T/F flags are read as bools.
+TRANSITION_COLUMNS = {
+    "OUTS_CT": "int8",
+    "START_BASES_CD": "int8",
+    "END_BASES_CD": "int8",
+    "EVENT_OUTS_CT": "int8",
+    "EVENT_RUNS_CT": "int8",
+}
+STATS_COLUMNS = {
+    "OUTS_CT": "int8",
+    "START_BASES_CD": "int8",
+    "EVENT_CD": "int8",
+    "EVENT_OUTS_CT": "int8",
+    "BATTEDBALL_CD": "category",
+    "DP_FL": "bool",
+    "BAT_DEST_ID": "int8",
+    "RUN1_DEST_ID": "int8",
+    "RUN2_DEST_ID": "int8",
+    "RUN3_DEST_ID": "int8",
+    "RUN1_SB_FL": "bool",
+    "RUN2_SB_FL": "bool",
+    "RUN1_CS_FL": "bool",
+    "RUN2_CS_FL": "bool",
+}
+
+# What the plays can be split up by (--group-by), and the column each one comes from. The year is the 4 digits after
+# the home team in GAME_ID.
+GROUP_BY_COLUMNS = {
+    "year": "GAME_ID",
+    "bat_team": "BAT_TEAM_ID",
+    "home_team": "HOME_TEAM_ID",
+    "bat_hand": "BAT_HAND_CD",
+    "pit_hand": "PIT_HAND_CD",
+    "batter": "BAT_ID",
+    "game": "GAME_ID",
+}
+GROUP_COLUMNS = {column: "category" for column in GROUP_BY_COLUMNS.values()}
+
+# Plays per chunk, so memory doesn't depend on how many years are loaded
+CHUNK_SIZE = 100_000
+
+# pack_plays.py saves every column of every year in here as a .npy file, with an index.json of where each file's
+# plays are
+PACKED_DIR = "packed"
+PACKED_VERSION = 1
+
+CACHE_DIR = "cache"
+# Bump this whenever what gets counted changes, so the old cache files are thrown out
+CACHE_VERSION = 1
+
+
+@contextmanager
+def atomic_write(file: str, mode: str = "w") -> Iterator[IO]:
+    """
+    Opens a temporary file to write file with, and moves it over file once the with block is done. Getting killed
+    halfway through writing then doesn't leave a broken file behind (or lose the old one). The temporary file is named
+    after the process, so processes writing the same file at once don't write over each other's.
+    """
+    temp_file = f"{file}.{os.getpid()}.tmp"
+    try:
+        with open(temp_file, mode) as f:
+            yield f
+        os.replace(temp_file, file)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+
+def ignore_interrupts(initializer: Callable | None, *initargs):
+    # ctrl-C sends SIGINT to the whole process group, workers leave it to the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+@contextmanager
+def process_pool(jobs: int, initializer: Callable | None = None, initargs: tuple = ()) -> Iterator[ProcessPoolExecutor]:
+    """
+    A ProcessPoolExecutor with jobs workers that ignore ctrl-C, so only the main process gets the KeyboardInterrupt
+    (workers killed halfway through a task break the pool, and shutting down a broken pool can hang). On the way out
+    of the with block, even on an error or ctrl-C, the tasks that haven't started are cancelled and the running ones
+    are waited for, so no workers get left behind.
+    """
+    executor = ProcessPoolExecutor(jobs, initializer=ignore_interrupts, initargs=(initializer, *initargs))
+    try:
+        yield executor
+    finally:
+        # Another ctrl-C (or the one sent to the whole process group) in the middle of shutting down would leave the
+        # pool half shut down and hang at exit, so the main process ignores it until the pool is gone
+        handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            executor.shutdown(cancel_futures=True)
+        finally:
+            signal.signal(signal.SIGINT, handler)
+
+
+def data_files(start_year: int, end_year: int) -> list[str]:
+    """
+    Paths of the files in data/ between start_year and end_year (inclusive). Exits if there aren't any.
+    """
+    if start_year > end_year:
+        print("START_YEAR must be less than END_YEAR", file=sys.stderr)
+        sys.exit(1)
+    elif start_year < start_data_year or end_year > end_data_year:
+        print(
+            f"START_YEAR and END_YEAR must be between {start_data_year} and {end_data_year}. If {end_data_year + 1} or a future year has been added to retrosheet, feel free to edit this file.",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+    if not os.path.isdir("data"):
+        print("The folder data doesn't exist. Have you run retrosheet_to_csv.sh?", file=sys.stderr)
+        sys.exit(1)
+    files = sorted(os.listdir("data"))
+    if not len(files):
+        print("The folder data doesn't have any files. Have you run retrosheet_to_csv.sh?", file=sys.stderr)
+        sys.exit(1)
+
+    return ["data/" + file for file in files if start_year <= int(file[0:4]) <= end_year]
+
+
+def files_by_year(files: Iterable[str]) -> dict[int, list[str]]:
+    years: dict[int, list[str]] = {}
+    for file in files:
+        years.setdefault(int(os.path.basename(file)[0:4]), []).append(file)
+    return years
+
+
+def read_csv_plays(file: str, columns: dict[str, str], chunk_size: int = CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    return pd.read_csv(
+        file,
+        usecols=list(columns),
+        dtype=columns,
+        true_values=["T"],
+        false_values=["F"],
+        chunksize=chunk_size,
+    )
+
+
+def packed_index() -> dict | None:
+    try:
+        with open(os.path.join(PACKED_DIR, "index.json"), "r") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return index if index["version"] == PACKED_VERSION else None
+
+
+def packed_entry(index: dict | None, file: str, columns: Iterable[str]) -> dict | None:
+    """
+    Where file's plays are in the packed store, or None if it isn't packed (or has changed since it was packed, or
+    the store doesn't have all of columns)
+    """
+    if index is None or not set(columns) <= set(index["columns"]):
+        return None
+    entry = index["files"].get(os.path.basename(file))
+    if entry is None or [entry["size"], entry["mtime_ns"]] != [os.stat(file).st_size, os.stat(file).st_mtime_ns]:
+        return None
+    return entry
+
+
+def read_plays(files: Iterable[str], columns: dict[str, str], chunk_size: int = CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """
+    Reads the plays in files chunk by chunk, with only the given columns (a dict of column name to dtype).
+    Files that are in the packed store (pack_plays.py) are sliced out of its memory-mapped columns instead of
+    parsing the CSV.
+    """
+    index = packed_index()
+    for file in files:
+        entry = packed_entry(index, file, columns)
+        if entry is None:
+            yield from read_csv_plays(file, columns, chunk_size)
+            continue
+
+        year = entry["year"]
+        categories = index["years"][year]["categories"]
+        arrays = {column: np.load(os.path.join(PACKED_DIR, year, column + ".npy"), mmap_mode="r") for column in columns}
+        for start in range(entry["start"], entry["stop"], chunk_size):
+            stop = min(start + chunk_size, entry["stop"])
+            chunk = {}
+            for column, array in arrays.items():
+                if column in categories:
+                    chunk[column] = pd.Categorical.from_codes(array[start:stop], categories=categories[column])
+                else:
+                    chunk[column] = array[start:stop]
+            yield pd.DataFrame(chunk, copy=False)
+
+
+def cache_key(files: list[str]) -> list:
+    # Re-downloading or regenerating a file changes its mtime, adding or removing a team changes the list
+    return [CACHE_VERSION] + [
+        [os.path.basename(file), os.stat(file).st_size, os.stat(file).st_mtime_ns] for file in files
+    ]
+
+
+def group_codes(plays: pd.DataFrame, group_by: Iterable[str]) -> tuple[np.ndarray, list[tuple]]:
+    """
+    Which group (a combination of the group_by values) each play is in, and the labels of the groups
+    """
+    key_codes = []
+    key_labels = []
+    for key in group_by:
+        codes, uniques = pd.factorize(plays[GROUP_BY_COLUMNS[key]])
+        labels = [str(value) for value in uniques]
+        if key == "year":
+            labels = [label[3:7] for label in labels]
+        # Missing values get a group of their own
+        codes = np.where(codes == -1, len(labels), codes)
+        labels.append("")
+        # Different game IDs can have the same year
+        label_codes, labels = pd.factorize(np.array(labels, dtype=object))
+        key_codes.append(label_codes[codes])
+        key_labels.append(list(labels))
+
+    sizes = [len(labels) for labels in key_labels]
+    combined, group = np.unique(np.ravel_multi_index(key_codes, sizes), return_inverse=True)
+    groups = [
+        tuple(labels[code] for labels, code in zip(key_labels, codes))
+        for codes in zip(*np.unravel_index(combined, sizes))
+    ]
+    return group.reshape(-1), groups
+
+
+class GroupedCounts:
+    """
+    Counts from an accumulator class (TransitionCounts, StatsCounts) split up by the group_by columns, like one set of
+    transition counts for each year and batting team. counts has one row per group, groups has their labels. Groups
+    that show up in different chunks or files get matched up by their labels when they're added together.
+    """
+
+    __slots__ = ("accumulator", "group_by", "groups", "counts")
+
+    def __init__(self, accumulator: type, group_by: Iterable[str], groups: Iterable[tuple] = (), counts=None):
+        self.accumulator = accumulator
+        self.group_by = tuple(group_by)
+        self.groups = [tuple(group) for group in groups]
+        if counts is None:
+            counts = np.zeros((0,) + accumulator().counts.shape, dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+
+    @property
+    def COLUMNS(self) -> dict[str, str]:
+        return {**self.accumulator.COLUMNS, **{GROUP_BY_COLUMNS[key]: "category" for key in self.group_by}}
+
+    def from_plays(self, plays: pd.DataFrame) -> "GroupedCounts":
+        group, groups = group_codes(plays, self.group_by)
+        counts = self.accumulator.from_plays(plays, group, len(groups)).counts
+        return GroupedCounts(self.accumulator, self.group_by, groups, counts)
+
+    def __add__(self, other: "GroupedCounts") -> "GroupedCounts":
+        groups = list(dict.fromkeys(self.groups + other.groups))
+        index = {group: i for i, group in enumerate(groups)}
+        counts = np.zeros((len(groups),) + self.counts.shape[1:], dtype=np.int64)
+        counts[[index[group] for group in self.groups]] += self.counts
+        counts[[index[group] for group in other.groups]] += other.counts
+        return GroupedCounts(self.accumulator, self.group_by, groups, counts)
+
+    def sorted(self) -> "GroupedCounts":
+        order = sorted(range(len(self.groups)), key=lambda i: self.groups[i])
+        return GroupedCounts(self.accumulator, self.group_by, [self.groups[i] for i in order], self.counts[order])
+
+    def totals(self):
+        """
+        The counts of every group as the accumulator class (with the groups as the first axis)
+        """
+        return self.accumulator(self.counts)
+
+    def to_json(self) -> dict:
+        # Most of the counts are 0 when there are a lot of groups, so only the rest get saved
+        (index,) = np.nonzero(self.counts.ravel())
+        return {
+            "groups": [list(group) for group in self.groups],
+            "shape": list(self.counts.shape),
+            "index": index.tolist(),
+            "values": self.counts.ravel()[index].tolist(),
+        }
+
+    def from_json(self, data: dict) -> "GroupedCounts":
+        counts = np.zeros(data["shape"], dtype=np.int64)
+        counts.ravel()[data["index"]] = data["values"]
+        return GroupedCounts(self.accumulator, self.group_by, data["groups"], counts)
+
+
+def count_files(files: list[str], accumulators: dict) -> dict:
+    """
+    Reads the plays in files once and counts each chunk with every accumulator. accumulators is a dict of name to an
+    empty accumulator (like TransitionCounts() or StatsCounts()) with the COLUMNS it needs, from_plays() to count a
+    chunk of plays, + to add counts up, and to_json()/from_json() for the cache. Returns the counts for each name.
+    """
+    columns = {}
+    for accumulator in accumulators.values():
+        columns.update(accumulator.COLUMNS)
+    counts = dict(accumulators)
+    for plays in read_plays(files, columns):
+        for name, accumulator in accumulators.items():
+            counts[name] = counts[name] + accumulator.from_plays(plays)
+    return counts
+
+
+def cached_counts(accumulators: dict, files: list[str], jobs: int = 1) -> dict[str, list]:
+    """
+    Counts for each accumulator (like in count_files) for each year of files. Each year's counts are saved in
+    cache/<name>_<year>.json and after that the year only gets counted again if its files change (or another
+    accumulator needs it counted).
+
+    The files of the years that aren't cached are counted one at a time, split across jobs processes.
+    """
+    years = files_by_year(files)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    counts: dict[int, dict] = {}
+    for year, year_files in years.items():
+        year_counts = {}
+        for name, accumulator in accumulators.items():
+            try:
+                with open(os.path.join(CACHE_DIR, f"{name}_{year}.json"), "r") as f:
+                    cached = json.load(f)
+            except (OSError, ValueError):
+                break
+            if cached["key"] != cache_key(year_files):
+                break
+            year_counts[name] = accumulator.from_json(cached["counts"])
+        else:
+            counts[year] = year_counts
+
+    missing = [file for year, year_files in years.items() if year not in counts for file in year_files]
+    files_left = {year: len(year_files) for year, year_files in years.items() if year not in counts}
+
+    def add_file(file, file_counts):
+        year = int(os.path.basename(file)[0:4])
+        if year in counts:
+            counts[year] = {name: counts[year][name] + file_counts[name] for name in accumulators}
+        else:
+            counts[year] = file_counts
+        files_left[year] -= 1
+        if files_left[year] == 0:
+            for name, year_counts in counts[year].items():
+                with atomic_write(os.path.join(CACHE_DIR, f"{name}_{year}.json")) as f:
+                    json.dump({"key": cache_key(years[year]), "counts": year_counts.to_json()}, f)
+
+    if jobs > 1:
+        with process_pool(jobs) as executor:
+            futures = {executor.submit(count_files, [file], accumulators): file for file in missing}
+            for future in tqdm(as_completed(futures), total=len(missing)):
+                add_file(futures[future], future.result())
+    else:
+        for file in tqdm(missing):
+            add_file(file, count_files([file], accumulators))
+    return {name: [counts[year][name] for year in sorted(years)] for name in accumulators}
+
+
+def write_table(table: pd.DataFrame, out_file: str, format: str):
+    """
+    Writes a table as a csv, parquet or npy file, which is what --format picks in the scripts that make tables
+    """
+    if format == "parquet":
+        try:
+            table.to_parquet(out_file, index=False)
+        except ImportError:
+            print("Writing parquet files needs pyarrow (pip install pyarrow)", file=sys.stderr)
+            sys.exit(1)
+    elif format == "npy":
+        # A structured array, so it can be opened with np.load(out_file, mmap_mode="r"). Strings have to be fixed
+        # width for that.
+        strings = {
+            column: f"U{max(table[column].astype(str).str.len().max(), 1)}"
+            for column in table.columns
+            if not pd.api.types.is_numeric_dtype(table[column]) and not pd.api.types.is_bool_dtype(table[column])
+        }
+        np.save(out_file, table.to_records(index=False, column_dtypes=strings))
+    else:
+        table.to_csv(out_file, index=False)
@@ -0,0 +1,70 @@
+import argparse
+import csv
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Enough runs to take any run differential from -30 to past +30 (or the other way) in one half-inning
+MAX_RUNS = 61
+
+
+def run_distribution(matrix, max_runs: int = MAX_RUNS) -> np.ndarray:
+    """
+    Distribution of the runs scored in the rest of the half-inning for each of the 24 base-out states.
+    Row is outs * 8 + base state, column is the number of runs. The last column is max_runs or more runs.
+    """
+    matrix = np.asarray(matrix, dtype=float)
+    matrix = matrix / matrix.sum(axis=1, keepdims=True)
+    # transient[runs][start, end] is the probability of going from start to end (with less than 3 outs) scoring runs
+    transient = matrix[:, :120].reshape(24, 24, 5).transpose(2, 0, 1)
+    # The inning over states, 3 outs with 0-3 runs scored
+    absorbing = matrix[:, 120:124]
+    # States can loop back to themselves without scoring (outs never go down, but the bases can), so the
+    # runs = 0 part of the chain has to be solved as a linear system rather than just stepped through
+    no_run_steps = np.linalg.inv(np.eye(24) - transient[0])
+
+    distribution = np.zeros((24, max_runs + 1))
+    for runs in range(max_runs + 1):
+        total = absorbing[:, runs].copy() if runs < absorbing.shape[1] else np.zeros(24)
+        for runs_on_play in range(1, min(runs, transient.shape[0] - 1) + 1):
+            total += transient[runs_on_play] @ distribution[:, runs - runs_on_play]
+        distribution[:, runs] = no_run_steps @ total
+    distribution[:, max_runs] = np.clip(1 - distribution[:, :max_runs].sum(axis=1), 0, None)
+    return distribution
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--matrix-file", "-f", help="Matrix file", type=str, default="transition_matrix.csv")
+    parser.add_argument(
+        "--out-file", "-o", help="Run distribution output file", type=str, default="run_distribution.csv"
+    )
+    parser.add_argument("--re24-file", "-r", help="RE24 output file", type=str, default="re24.csv")
+    parser.add_argument(
+        "--max-runs",
+        "-m",
+        help="Runs in the last column of the run distribution (that many or more)",
+        type=int,
+        default=10,
+    )
+    args = parser.parse_args(sys.argv[1:])
+    with open(args.matrix_file, "r") as f:
+        r = csv.reader(f)
+        matrix = np.array([row for row in r], dtype=float)
+
+    distribution = run_distribution(matrix)
+    states = pd.DataFrame({"outs": np.arange(24) // 8, "base_state": np.arange(24) % 8})
+    expected_runs = distribution @ np.arange(distribution.shape[1])
+    states.assign(expected_runs=expected_runs).to_csv(args.re24_file, index=False)
+
+    # Lump everything past --max-runs into the last column
+    columns = np.minimum(np.arange(distribution.shape[1]), args.max_runs)
+    lumped = np.zeros((24, args.max_runs + 1))
+    np.add.at(lumped.T, columns, distribution.T)
+    runs = pd.DataFrame(lumped, columns=[f"runs_{runs}" for runs in range(args.max_runs + 1)])
+    pd.concat([states, runs], axis=1).to_csv(args.out_file, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import argparse
+import bisect
+import csv
+import sys
+import time
+
+import numpy as np
+from numpy import random
+
+
+def check_matrix(matrix, name="the matrix"):
+    """
+    Raises a ValueError naming the first row of matrix that isn't finite, not negative and adding up to 1 (like the
+    rows of a transition matrix)
+    """
+    matrix = np.asarray(matrix, dtype=float)
+    for row in range(matrix.shape[0]):
+        if not np.all(np.isfinite(matrix[row])):
+            raise ValueError(f"Row {row} of {name} isn't finite (is it a state that never came up in the data?)")
+        if np.any(matrix[row] < 0) or abs(matrix[row].sum() - 1) > 1e-6:
+            raise ValueError(f"Row {row} of {name} can't be negative and has to add up to 1, got {matrix[row].sum()}")
+
+
+class AliasSampler:
+    """
+    Walker alias tables for sampling a column from any row of a weight matrix (like the 24x124 transition matrix)
+    in constant time. Only the nonzero columns of each row go in the tables, and random numbers are generated in
+    blocks rather than one rng.random() call per sample.
+
+    draw() samples one row at a time (for simulate_game), sample() samples an array of rows at once. Both take the rng
+    to sample with, so one sampler can be shared by simulations with their own random streams. Every row has to add
+    up to 1 (see check_matrix).
+    """
+
+    def __init__(self, weights, block_size=1 << 16):
+        weights = np.asarray(weights, dtype=float)
+        check_matrix(weights)
+        self.block_size = block_size
+        self.sizes = np.count_nonzero(weights > 0, axis=1)
+        width = self.sizes.max()
+        # outcomes[row, i] is the column taken when slot i is picked and kept, alias[row, i] when it's rejected
+        self.outcomes = np.zeros((weights.shape[0], width), dtype=np.int64)
+        self.alias = np.zeros((weights.shape[0], width), dtype=np.int64)
+        self.probability = np.ones((weights.shape[0], width))
+        for row in range(weights.shape[0]):
+            (columns,) = np.nonzero(weights[row] > 0)
+            size = columns.shape[0]
+            self.outcomes[row, :size] = columns
+            self.alias[row, :size] = columns
+            # Vose's method: pair up slots with less than their fair share with ones that have more
+            scaled = weights[row, columns] / weights[row, columns].sum() * size
+            small = [i for i in range(size) if scaled[i] < 1]
+            large = [i for i in range(size) if scaled[i] >= 1]
+            while small and large:
+                less = small.pop()
+                more = large[-1]
+                self.probability[row, less] = scaled[less]
+                self.alias[row, less] = columns[more]
+                scaled[more] -= 1 - scaled[less]
+                if scaled[more] < 1:
+                    small.append(large.pop())
+            # Anything left over is only off from 1 by rounding error
+            for i in small + large:
+                self.probability[row, i] = 1
+
+        # Plain lists are a lot faster than NumPy arrays for indexing one element at a time
+        self._sizes = self.sizes.tolist()
+        self._outcomes = self.outcomes.tolist()
+        self._alias = self.alias.tolist()
+        self._probability = self.probability.tolist()
+        self._rng = None
+        self._block = []
+        self._position = 0
+
+    def draw(self, row, rng):
+        # The block of random numbers is thrown out for a different rng, so each rng's draws only depend on itself
+        if rng is not self._rng or self._position == len(self._block):
+            self._rng = rng
+            self._block = rng.random(self.block_size).tolist()
+            self._position = 0
+        u = self._block[self._position] * self._sizes[row]
+        self._position += 1
+        # The whole part of u picks the slot, the fractional part decides between it and its alias
+        slot = int(u)
+        if u - slot < self._probability[row][slot]:
+            return self._outcomes[row][slot]
+        return self._alias[row][slot]
+
+    def sample(self, rows, rng):
+        u = rng.random(rows.shape[0]) * self.sizes[rows]
+        slot = u.astype(np.int64)
+        return np.where(u - slot < self.probability[rows, slot], self.outcomes[rows, slot], self.alias[rows, slot])
+
+
+def main():
+    """
+    Micro-benchmark of the old bisect/searchsorted sampling against the alias tables
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--matrix-file", "-f", help="Matrix file", type=str, default="transition_matrix.csv")
+    parser.add_argument("--num-samples", "-n", help="Number of samples per benchmark", type=int, default=1_000_000)
+    args = parser.parse_args(sys.argv[1:])
+    with open(args.matrix_file, "r") as f:
+        r = csv.reader(f)
+        matrix = np.array([row for row in r], dtype=float)
+
+    rng = random.default_rng()
+    matrix_cumulative = np.cumsum(matrix, axis=1)
+    sampler = AliasSampler(matrix)
+    states = rng.integers(0, matrix.shape[0], args.num_samples)
+    state_list = states.tolist()
+    print(f"Nonzero outcomes per state: {sampler.sizes.min()}-{sampler.sizes.max()} of {matrix.shape[1]}")
+
+    def benchmark(name, sample):
+        start = time.perf_counter()
+        sample()
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {args.num_samples / elapsed:,.0f} samples/sec")
+
+    benchmark(
+        "bisect (one at a time)",
+        lambda: [bisect.bisect(matrix_cumulative[s], rng.random() * matrix_cumulative[s][-1]) for s in state_list],
+    )
+    benchmark("alias (one at a time)", lambda: [sampler.draw(s, rng) for s in state_list])
+    flat_cumulative = (matrix_cumulative / matrix_cumulative[:, -1:] + np.arange(matrix.shape[0])[:, None]).ravel()
+    benchmark(
+        "searchsorted (batch)",
+        lambda: np.searchsorted(flat_cumulative, states + rng.random(states.shape[0]), side="right"),
+    )
+    benchmark("alias (batch)", lambda: sampler.sample(states, rng))
+
+
+if __name__ == "__main__":
+    main()
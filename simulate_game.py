@@ -1,20 +1,22 @@
 import argparse
-import bisect
 import csv
+import json
 import sys
+import time
+from concurrent.futures import as_completed
+from functools import partial
 
 import numpy as np
 import pandas as pd
 from numpy import random
 from tqdm import tqdm
 
-sys.setrecursionlimit(1000000)
-rng = random.default_rng()
-
+from matrix_cache import cached_transition_matrix
+from plays import atomic_write, process_pool, write_table
+from run_distribution import run_distribution
+from sampler import AliasSampler, check_matrix
 
-def weighted_choice(weights):
-    global rng
-    return bisect.bisect(weights, rng.random() * weights[-1])
+sys.setrecursionlimit(1000000)
 
 
 # index is (((outs * 8 + base_state) * 61 + (run_diff_for_home_team + 30)) * 10 + (inning - 1)) * 2 + isBottom
@@ -23,18 +25,33 @@ def weighted_choice(weights):
 # run_diff_for_home_team is (index // 2 // 10) % 61 - 30
 # base_state is (index // 2 // 10 // 61) % 8
 # outs is (index // 2 // 10 // 61 // 8) % 3
-win_count = [0 for _ in range(3 * 8 * 61 * 10 * 2)]
-game_count = [0 for _ in range(3 * 8 * 61 * 10 * 2)]
+NUM_STATES = 3 * 8 * 61 * 10 * 2
+# Start of half-inning states for lineups, the same but with the lineup slot leading off instead of outs and bases
+NUM_SLOT_STATES = 9 * 61 * 10 * 2
+
+
+def decode_states(index):
+    """
+    Vectorized version of the formulas above, returns (inning_bottom, inning, run_diff_for_home_team, base_state, outs)
+    """
+    index, inning_bottom = np.divmod(index, 2)
+    index, inning = np.divmod(index, 10)
+    index, run_diff = np.divmod(index, 61)
+    outs, base_state = np.divmod(index, 8)
+    return inning_bottom, inning + 1, run_diff - 30, base_state, outs
 
 
 def simulate_game(
-    matrix,
+    sampler,
+    rng,
     starting_inning,
     starting_top_bottom,
     starting_base_state,
     starting_outs,
     starting_runs_home,
     starting_runs_away,
+    win_count,
+    game_count,
 ):
     game_states = set()
     inning_changeover = False
@@ -65,7 +82,7 @@ def simulate_game(
         )
 
         current_state = starting_outs * 8 + starting_base_state
-        new_state = weighted_choice(matrix[current_state])
+        new_state = sampler.draw(current_state, rng)
         runs_on_play = new_state % 5
         if starting_top_bottom == 0:
             new_runs_away = starting_runs_away + runs_on_play
@@ -121,118 +138,756 @@ def simulate_game(
         inning_changeover = False
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--num-its", "-n", help="Number of iterations per scenario", type=int, default=100_000)
-    parser.add_argument("--matrix-file", "-f", help="Matrix file", type=str, default="transition_matrix.csv")
-    parser.add_argument("--out-file", "-o", help="Output file", type=str, default="win_expectancy.csv")
+def credit_states(visited_games, visited_states, outcome, num_states, win_count, game_count):
+    if not visited_games:
+        return
+    games = np.concatenate(visited_games)
+    states = np.concatenate(visited_states)
+    finished = outcome[games] >= 0
+    # Like the game_states set in simulate_game, a state only counts once per game
+    keys = np.sort(games[finished] * num_states + states[finished])
+    keys = keys[np.concatenate(([True], keys[1:] != keys[:-1]))]
+    games, states = np.divmod(keys, num_states)
+    game_count += np.bincount(states, minlength=num_states)
+    win_count += np.bincount(states[outcome[games] == 1], minlength=num_states)
 
-    args = parser.parse_args(sys.argv[1:])
-    with open(args.matrix_file, "r") as f:
-        r = csv.reader(f)
-        matrix = np.array([row for row in r], dtype=float)
 
-    TOTAL_SIMS = args.num_its
-    matrix_cumulative = np.cumsum(matrix, axis=1)
-    for starting_inning in tqdm(range(1, 11), desc="Inning", position=0):
-        start_run_diff = -30
-        end_run_diff = 30
-        for run_diff in tqdm(
-            range(start_run_diff, end_run_diff + 1),
-            desc="Run diff",
-            position=1,
-            leave=False,
-        ):
-            starting_top_bottom = 0
-            starting_base_state = 0
-            starting_outs = 0
-            if run_diff > 0:
-                starting_runs_home = run_diff
-                starting_runs_away = 0
-            else:
-                starting_runs_home = 0
-                starting_runs_away = -run_diff
-            for i in tqdm(
-                range(TOTAL_SIMS * 2),
-                desc="Simulations",
-                position=2,
-                leave=False,
-            ):
-                starting_top_bottom = i % 2
+def finish_games_by_half_inning(
+    runs_sampler, rng, game_id, inning, top_bottom, run_diff, outcome, visited_games, visited_states
+):
+    """
+    Finishes games that are at the start of a half-inning by sampling the runs scored in whole half-innings, which
+    all start with nobody on and nobody out. Every game gets a block of half-innings (through the 10th inning, or one
+    more inning once it's extra innings) at once, and cumulative sums of the runs find where each one ends, with the
+    same rules as simulate_games_batch. Walk-offs still work, whether the home team wins in the bottom of the 9th or
+    later only depends on how many runs they score in the half-inning, not when. The start of every half-inning
+    played goes in visited_games/visited_states and the results in outcome.
+    """
+    # Everything about a half-inning that doesn't depend on the score, indexed by half-innings since the start of the
+    # game (games stop after the 30th inning, so blocks never go past 80)
+    half_innings = np.arange(80)
+    half_inning_inning, half_inning_top_bottom = np.divmod(half_innings, 2)
+    half_inning_inning += 1
+    next_inning, next_top_bottom = np.divmod(half_innings + 1, 2)
+    next_inning += 1
+    # The home team's runs count up and the away team's down
+    run_sign = half_inning_top_bottom * 2 - 1
+    too_late = half_inning_inning > 30
+    home_can_win = (next_inning >= 10) | ((next_inning == 9) & (next_top_bottom == 1))
+    away_can_win = (next_inning > 9) & (next_top_bottom == 0)
+    # Where the half-inning's start state is, apart from the run diff
+    state_offset = (np.minimum(half_inning_inning, 10) - 1) * 2 + half_inning_top_bottom
+
+    half_inning = (inning - 1) * 2 + top_bottom
+    while game_id.size:
+        block_size = max(18 - int(half_inning.min()), 0) + 2
+        block = half_inning[:, None] + np.arange(block_size)
+        scored = runs_sampler.sample(np.zeros(block.size, dtype=np.int64), rng).reshape(block.shape) * run_sign[block]
+        run_diff_after = run_diff[:, None] + np.cumsum(scored, axis=1)
+        run_diff_before = run_diff_after - scored
+        # Games stop before a half-inning once someone is up by more than 30 or it's past the 30th inning, and after
+        # one if someone won
+        stop_before = (np.abs(run_diff_before) > 30) | too_late[block]
+        home_win = (run_diff_after > 0) & home_can_win[block]
+        win = home_win | ((run_diff_after < 0) & away_can_win[block])
+        first_stop_before = np.where(stop_before.any(axis=1), stop_before.argmax(axis=1), block_size)
+        first_win = np.where(win.any(axis=1), win.argmax(axis=1), block_size)
+
+        played = np.arange(block_size) < np.minimum(first_stop_before, first_win + 1)[:, None]
+        visited_games.append(game_id[np.nonzero(played)[0]])
+        visited_states.append((run_diff_before[played] + 30) * 20 + state_offset[block[played]])
+
+        stopped = (first_stop_before <= first_win) & (first_stop_before < block_size)
+        games = np.flatnonzero(stopped)
+        stop_run_diff = run_diff_before[games, first_stop_before[games]]
+        outcome[game_id[games[stop_run_diff > 30]]] = 1
+        outcome[game_id[games[stop_run_diff < -30]]] = 0
+        won = (first_win < first_stop_before) & (first_win < block_size)
+        games = np.flatnonzero(won)
+        outcome[game_id[games]] = home_win[games, first_win[games]]
+
+        unfinished = ~(stopped | won)
+        game_id = game_id[unfinished]
+        half_inning = half_inning[unfinished] + block_size
+        run_diff = run_diff_after[unfinished, -1]
+
+
+def simulate_games_batch(
+    sampler,
+    rng,
+    starting_inning,
+    starting_top_bottom,
+    starting_base_state,
+    starting_outs,
+    starting_runs_home,
+    starting_runs_away,
+    win_count,
+    game_count,
+    runs_sampler=None,
+    starting_batter_slots=None,
+    slot_win_count=None,
+    slot_game_count=None,
+):
+    """
+    Same rules as simulate_game, but every game in starting_top_bottom (an array, one entry per game) is played
+    in lockstep. Each step samples one transition for every unfinished game, and finished games are dropped
+    from the arrays. The visited states are only credited to win_count/game_count once the whole batch is done.
+
+    If runs_sampler (an AliasSampler over run_distribution) is given, only the first half-inning is played plate
+    appearance by plate appearance, and the rest of each game is finished by finish_games_by_half_inning.
+
+    If starting_batter_slots (the away and home lineup slot up next for each game, shape (games, 2)) is given,
+    sampler has to be over the (2 * 9 * 24, 124) lineup matrices (see lineup_matrices) and the batting order is
+    tracked. The start of every half-inning is then also credited to slot_win_count/slot_game_count, indexed
+    by ((leadoff_slot * 61 + (run_diff_for_home_team + 30)) * 10 + (inning - 1)) * 2 + isBottom.
+    """
+    top_bottom = np.array(starting_top_bottom, dtype=np.int64)
+    num_games = top_bottom.shape[0]
+    game_id = np.arange(num_games)
+    inning = np.full(num_games, starting_inning, dtype=np.int64)
+    base_state = np.full(num_games, starting_base_state, dtype=np.int64)
+    outs = np.full(num_games, starting_outs, dtype=np.int64)
+    runs_home = np.full(num_games, starting_runs_home, dtype=np.int64)
+    runs_away = np.full(num_games, starting_runs_away, dtype=np.int64)
+    lineups = starting_batter_slots is not None
+    if lineups:
+        batter_slots = np.array(starting_batter_slots, dtype=np.int64)
+    else:
+        batter_slots = np.zeros((num_games, 2), dtype=np.int64)
+    half_inning_start = np.ones(num_games, dtype=bool)
+    # 1 if the home team won, 0 if the away team won and -1 if the game went past the 30th inning
+    outcome = np.full(num_games, -1, dtype=np.int8)
+    visited_games = []
+    visited_states = []
+    visited_slot_games = []
+    visited_slot_states = []
+    first_half_inning_over = []
+    while game_id.size:
+        run_diff = runs_home - runs_away
+        outcome[game_id[run_diff > 30]] = 1
+        outcome[game_id[run_diff < -30]] = 0
+        alive = (np.abs(run_diff) <= 30) & (inning <= 30)
+        (
+            game_id,
+            inning,
+            top_bottom,
+            base_state,
+            outs,
+            runs_home,
+            runs_away,
+            run_diff,
+            batter_slots,
+            half_inning_start,
+        ) = (
+            arr[alive]
+            for arr in (
+                game_id,
+                inning,
+                top_bottom,
+                base_state,
+                outs,
+                runs_home,
+                runs_away,
+                run_diff,
+                batter_slots,
+                half_inning_start,
+            )
+        )
+        if not game_id.size:
+            break
+        inning_state = np.minimum(inning, 10)
+        visited_games.append(game_id)
+        visited_states.append(
+            (((outs * 8 + base_state) * 61 + (run_diff + 30)) * 10 + (inning_state - 1)) * 2 + top_bottom
+        )
+
+        current_state = outs * 8 + base_state
+        if lineups:
+            batting_slot = batter_slots[np.arange(game_id.size), top_bottom]
+            visited_slot_games.append(game_id[half_inning_start])
+            slot_state = ((batting_slot * 61 + (run_diff + 30)) * 10 + (inning_state - 1)) * 2 + top_bottom
+            visited_slot_states.append(slot_state[half_inning_start])
+            new_state = sampler.sample((top_bottom * 9 + batting_slot) * 24 + current_state, rng)
+            batter_slots[np.arange(game_id.size), top_bottom] = (batting_slot + 1) % 9
+        else:
+            new_state = sampler.sample(current_state, rng)
+        runs_on_play = new_state % 5
+        new_start_state = new_state // 5
+        outs = new_start_state // 8
+        base_state = new_start_state % 8
+        runs_away = runs_away + runs_on_play * (1 - top_bottom)
+        runs_home = runs_home + runs_on_play * top_bottom
+
+        # Reset the inning
+        inning_changeover = outs == 3
+        base_state[inning_changeover] = 0
+        outs[inning_changeover] = 0
+        inning = inning + (inning_changeover & (top_bottom == 1))
+        top_bottom = np.where(inning_changeover, 1 - top_bottom, top_bottom)
+        half_inning_start = inning_changeover
+
+        home_leads = runs_home > runs_away
+        home_win = ((inning >= 10) & home_leads & (inning_changeover | (top_bottom == 1))) | (
+            (inning == 9) & (top_bottom == 1) & home_leads
+        )
+        away_win = (inning > 9) & (top_bottom == 0) & (runs_away > runs_home) & inning_changeover
+        outcome[game_id[home_win]] = 1
+        outcome[game_id[away_win]] = 0
+        alive = ~(home_win | away_win)
+        if runs_sampler is not None:
+            # Once the first half-inning is over, the rest of the game only needs the runs scored in each half-inning
+            over = alive & inning_changeover
+            first_half_inning_over.append(
+                (game_id[over], inning[over], top_bottom[over], (runs_home - runs_away)[over])
+            )
+            alive &= ~inning_changeover
+        (
+            game_id,
+            inning,
+            top_bottom,
+            base_state,
+            outs,
+            runs_home,
+            runs_away,
+            batter_slots,
+            half_inning_start,
+        ) = (
+            arr[alive]
+            for arr in (
+                game_id,
+                inning,
+                top_bottom,
+                base_state,
+                outs,
+                runs_home,
+                runs_away,
+                batter_slots,
+                half_inning_start,
+            )
+        )
+
+    if first_half_inning_over:
+        finish_games_by_half_inning(
+            runs_sampler,
+            rng,
+            *(np.concatenate(arrays) for arrays in zip(*first_half_inning_over)),
+            outcome,
+            visited_games,
+            visited_states,
+        )
+    credit_states(visited_games, visited_states, outcome, NUM_STATES, win_count, game_count)
+    if lineups:
+        credit_states(
+            visited_slot_games, visited_slot_states, outcome, NUM_SLOT_STATES, slot_win_count, slot_game_count
+        )
+
+
+def exact_win_expectancy(matrix, last_inning=30):
+    """
+    Solve for the win expectancy of every state instead of simulating it. Works backwards one half-inning at a
+    time: the win expectancy at any point in a half-inning is the distribution of the runs scored in the rest of
+    the half-inning (from run_distribution) times the win expectancy at the start of the next half-inning.
+    Extra innings are solved back from last_inning (the simulator also gives up after the 30th inning), which
+    ends up in the inning 10 slot, as does the Manfred runner (0 outs, runner on second).
+    """
+    runs = run_distribution(matrix)
+    max_runs = runs.shape[1] - 1
+    run_diffs = np.arange(-30, 31)
+    # Half-inning end states go from run_diffs - max_runs to run_diffs + max_runs
+    end_run_diffs = np.arange(-30 - max_runs, 31 + max_runs)
+    run_range = np.arange(max_runs + 1)
+    # end_index[is_bottom][run_diff, runs] is where the half-inning ends up in end_run_diffs
+    end_index = [
+        run_diffs[:, None] - run_range[None, :] + 30 + max_runs,
+        run_diffs[:, None] + run_range[None, :] + 30 + max_runs,
+    ]
+
+    def solve_half_inning(after_half_inning, is_bottom):
+        # after_half_inning is the win expectancy for every end_run_diffs once the 3rd out is made
+        after_half_inning = after_half_inning.copy()
+        after_half_inning[end_run_diffs > 30] = 1
+        after_half_inning[end_run_diffs < -30] = 0
+        # (24, 61) win expectancy for every base-out state and run diff
+        return runs @ after_half_inning[end_index[is_bottom]].T
+
+    def half_inning_start(next_win_expectancy):
+        # The win expectancy at the start of the next half-inning, 0 outs and the bases empty
+        after_half_inning = np.empty(end_run_diffs.shape)
+        after_half_inning[np.abs(end_run_diffs) <= 30] = next_win_expectancy[0]
+        return after_half_inning
+
+    win_expectancy = np.empty((24, 61, 10, 2))
+    # Past last_inning it's a coin flip
+    top_win_expectancy = np.full((24, 61), 0.5)
+    for inning in range(last_inning, 0, -1):
+        if inning >= 9:
+            # Once the bottom of the 9th or later is over, the game is over unless it's tied
+            after_half_inning = (end_run_diffs > 0).astype(float)
+            after_half_inning[end_run_diffs == 0] = top_win_expectancy[0, 30]
+        else:
+            after_half_inning = half_inning_start(top_win_expectancy)
+        bottom_win_expectancy = solve_half_inning(after_half_inning, 1)
+        top_win_expectancy = solve_half_inning(half_inning_start(bottom_win_expectancy), 0)
+        inning_state = min(inning, 10)
+        win_expectancy[:, :, inning_state - 1, 0] = top_win_expectancy
+        win_expectancy[:, :, inning_state - 1, 1] = bottom_win_expectancy
+    return win_expectancy.ravel()
+
+
+def standard_error(wins, games, z=1.96):
+    """
+    Half-width of the Wilson score interval divided by z. Unlike sqrt(p * (1 - p) / n), it doesn't drop to 0
+    when every game so far was a win (or a loss).
+    """
+    p = wins / games
+    return np.sqrt(p * (1 - p) / games + z**2 / (4 * games**2)) / (1 + z**2 / games)
+
+
+def start_scenarios():
+    """
+    Every (inning, run diff, top/bottom, base state) a batch of games starts from
+    """
+    scenarios = []
+    for starting_inning in range(1, 11):
+        for run_diff in range(-30, 31):
+            for starting_top_bottom in range(2):
+                scenarios.append((starting_inning, run_diff, starting_top_bottom, 0b000))
+                if starting_inning == 10:
+                    # Manfred runner, need to make sure there's a sufficient sample size
+                    scenarios.append((starting_inning, run_diff, starting_top_bottom, 0b010))
+    return scenarios
+
+
+def make_samplers(matrix, engine):
+    """
+    The AliasSampler over the rows of matrix (one 24x124 matrix or the (2, 9, 24, 124) lineup_matrices) and, for
+    the half-inning engine, the one over its run_distribution. These only depend on the matrix, so they're made
+    once and every scenario draws from them with its own rng.
+    """
+    sampler = AliasSampler(matrix.reshape(-1, matrix.shape[-1]))
+    runs_sampler = AliasSampler(run_distribution(matrix)) if engine == "half-inning" else None
+    return sampler, runs_sampler, matrix.ndim == 4
+
+
+# The samplers of each worker process, set once by init_worker
+worker_samplers = None
+
+
+def init_worker(matrix, engine):
+    global worker_samplers
+    worker_samplers = make_samplers(matrix, engine)
+
+
+def simulate_scenario_in_worker(*args):
+    return simulate_scenario(*worker_samplers, *args)
+
+
+def simulate_scenario(sampler, runs_sampler, lineups, num_its, engine, batch_size, target_se, scenario, seed):
+    """
+    Simulate num_its games from one start scenario with its own random stream and return its own win_count,
+    game_count, slot_win_count and slot_game_count. With target_se, stop early once the standard error of the
+    start state is below it. The samplers come from make_samplers, and with lineups the lineup slots leading off
+    are random (other than the first inning).
+    """
+    starting_inning, run_diff, starting_top_bottom, starting_base_state = scenario
+    rng = random.default_rng(seed)
+    win_count = np.zeros(NUM_STATES, dtype=np.int64)
+    game_count = np.zeros(NUM_STATES, dtype=np.int64)
+    slot_win_count = np.zeros(NUM_SLOT_STATES, dtype=np.int64)
+    slot_game_count = np.zeros(NUM_SLOT_STATES, dtype=np.int64)
+    starting_outs = 0
+    if run_diff > 0:
+        starting_runs_home = run_diff
+        starting_runs_away = 0
+    else:
+        starting_runs_home = 0
+        starting_runs_away = -run_diff
+    start_state = (
+        ((starting_outs * 8 + starting_base_state) * 61 + (run_diff + 30)) * 10 + (starting_inning - 1)
+    ) * 2 + starting_top_bottom
+
+    games_played = 0
+    # With a target standard error, start small so that near certain scenarios only take a handful of games
+    games_in_batch = batch_size if target_se is None else min(batch_size, 100)
+    while games_played < num_its:
+        games_in_batch = min(games_in_batch, num_its - games_played)
+        if engine == "scalar":
+            for _ in range(games_in_batch):
                 simulate_game(
-                    matrix_cumulative,
+                    sampler,
+                    rng,
                     starting_inning,
                     starting_top_bottom,
                     starting_base_state,
                     starting_outs,
                     starting_runs_home,
                     starting_runs_away,
+                    win_count,
+                    game_count,
                 )
-            if starting_inning == 10:
-                # Manfred runner, need to make sure there's a sufficient sample size
-                starting_base_state = 0b010
-                for _ in tqdm(
-                    range(TOTAL_SIMS * 2),
-                    desc="Simulations",
-                    position=2,
-                    leave=False,
-                ):
-                    starting_top_bottom = i % 2
-                    simulate_game(
-                        matrix_cumulative,
-                        starting_inning,
-                        starting_top_bottom,
-                        starting_base_state,
-                        starting_outs,
-                        starting_runs_home,
-                        starting_runs_away,
-                    )
+        else:
+            starting_batter_slots = None
+            if lineups:
+                starting_batter_slots = rng.integers(0, 9, (games_in_batch, 2))
+                if starting_inning == 1:
+                    # Nobody has batted yet, apart from the away team if it's the bottom of the 1st
+                    starting_batter_slots[:, starting_top_bottom:] = 0
+            simulate_games_batch(
+                sampler,
+                rng,
+                starting_inning,
+                np.full(games_in_batch, starting_top_bottom),
+                starting_base_state,
+                starting_outs,
+                starting_runs_home,
+                starting_runs_away,
+                win_count,
+                game_count,
+                runs_sampler=runs_sampler,
+                starting_batter_slots=starting_batter_slots,
+                slot_win_count=slot_win_count,
+                slot_game_count=slot_game_count,
+            )
+        games_played += games_in_batch
+
+        if target_se is not None and game_count[start_state]:
+            wins, games = win_count[start_state], game_count[start_state]
+            if standard_error(wins, games) < target_se:
+                break
+            # Guess how many more games it takes to get there from the win expectancy so far
+            p = (wins + 1) / (games + 2)
+            games_in_batch = int(np.clip(p * (1 - p) / target_se**2 - games, 100, batch_size))
+    return win_count, game_count, slot_win_count, slot_game_count
+
+
+def save_checkpoint(checkpoint_file, **arrays):
+    with atomic_write(checkpoint_file, "wb") as f:
+        np.savez_compressed(f, **arrays)
 
+
+def load_checkpoint(checkpoint_file):
+    with np.load(checkpoint_file) as checkpoint:
+        return {key: checkpoint[key] for key in checkpoint.files}
+
+
+def simulate_scenarios(
+    matrix,
+    num_its,
+    engine,
+    batch_size,
+    workers=1,
+    seed=None,
+    target_se=None,
+    checkpoint_file=None,
+    checkpoint_interval=300,
+    resume=None,
+):
+    """
+    Simulate num_its games from every start scenario (or until target_se) and return win_count, game_count,
+    slot_win_count and slot_game_count (the last two are only filled in for lineups).
+    Every scenario gets its own child of the seed's SeedSequence, so the results for a given seed are the same
+    no matter how many worker processes the scenarios are split across.
+
+    Every checkpoint_interval seconds (and on ctrl-C) the counts, the seed and which scenarios are done are saved
+    to checkpoint_file. Passing a loaded checkpoint as resume skips the finished scenarios, and since unfinished
+    scenarios start over from their own seed, the results are the same as if the run was never stopped.
+    """
+    scenarios = start_scenarios()
+    count_names = ["win_count", "game_count", "slot_win_count", "slot_game_count"]
+    if resume is not None:
+        seed = int(resume["entropy"])
+        completed = resume["completed"]
+        counts = [resume[name] for name in count_names]
+    else:
+        completed = np.zeros(len(scenarios), dtype=bool)
+        counts = [np.zeros(size, dtype=np.int64) for size in (NUM_STATES, NUM_STATES, NUM_SLOT_STATES, NUM_SLOT_STATES)]
+    seed_sequence = random.SeedSequence(seed)
+    seeds = seed_sequence.spawn(len(scenarios))
+    settings = (num_its, engine, batch_size, target_se)
+    remaining = np.flatnonzero(~completed)
+    # The counts and which scenarios they include always get replaced together, so a ctrl-C can't land in between
+    progress = (counts, completed)
+    last_checkpoint = time.monotonic()
+
+    def checkpoint():
+        counts, completed = progress
+        save_checkpoint(
+            checkpoint_file,
+            matrix=matrix,
+            num_its=num_its,
+            engine=engine,
+            batch_size=batch_size,
+            target_se=np.nan if target_se is None else target_se,
+            # The entropy can be bigger than any NumPy integer
+            entropy=str(seed_sequence.entropy),
+            completed=completed,
+            **dict(zip(count_names, counts)),
+        )
+
+    def add_scenario(index, scenario_counts):
+        nonlocal progress, last_checkpoint
+        counts, completed = progress
+        completed = completed.copy()
+        completed[index] = True
+        progress = ([count + scenario_count for count, scenario_count in zip(counts, scenario_counts)], completed)
+        if checkpoint_file is not None and time.monotonic() - last_checkpoint >= checkpoint_interval:
+            checkpoint()
+            last_checkpoint = time.monotonic()
+
+    try:
+        if workers > 1:
+            # The pool is shut down before the except below saves the checkpoint
+            with process_pool(workers, init_worker, (matrix, engine)) as executor:
+                futures = {
+                    executor.submit(simulate_scenario_in_worker, *settings, scenarios[index], seeds[index]): index
+                    for index in remaining
+                }
+                for future in tqdm(as_completed(futures), total=len(remaining), desc="Scenarios"):
+                    add_scenario(futures[future], future.result())
+        else:
+            simulate = partial(simulate_scenario, *make_samplers(matrix, engine), *settings)
+            for index in tqdm(remaining, desc="Scenarios"):
+                add_scenario(index, simulate(scenarios[index], seeds[index]))
+    except KeyboardInterrupt:
+        if checkpoint_file is not None:
+            checkpoint()
+            print(f"Saved a checkpoint to {checkpoint_file}, continue with --resume {checkpoint_file}", file=sys.stderr)
+        raise
+    if checkpoint_file is not None:
+        checkpoint()
+
+    win_count, game_count, slot_win_count, slot_game_count = progress[0]
     # Prevent NAN in certain home team win states
-    for state in range(len(win_count)):
-        inning_bottom = state % 2
-        inning = (state // 2) % 10 + 1
-        run_diff_for_home_team = (state // 2 // 10) % 61 - 30
-        base_state = (state // 2 // 10 // 61) % 8
-        outs = (state // 2 // 10 // 61 // 8) % 3
-        # Check if the home team wins
-        if (inning >= 10 and run_diff_for_home_team > 0) or (
-            inning == 9 and inning_bottom == 1 and run_diff_for_home_team > 0
-        ):
-            win_count[state] += 1
-            game_count[state] += 1
+    inning_bottom, inning, run_diff_for_home_team, _, _ = decode_states(np.arange(NUM_STATES))
+    # Check if the home team wins
+    home_won = ((inning >= 10) & (run_diff_for_home_team > 0)) | (
+        (inning == 9) & (inning_bottom == 1) & (run_diff_for_home_team > 0)
+    )
+    win_count[home_won] += 1
+    game_count[home_won] += 1
+    return win_count, game_count, slot_win_count, slot_game_count
+
+
+def read_matrix(matrix_file):
+    with open(matrix_file, "r") as f:
+        r = csv.reader(f)
+        matrix = np.array([row for row in r], dtype=float)
+    check_matrix(matrix, matrix_file)
+    return matrix
+
 
-    with np.errstate(divide="ignore", invalid="ignore"):
-        win_percent = np.reshape(np.divide(np.array(win_count), np.array(game_count)), (-1, 1))
+def lineup_matrices(matrix, away_lineup_files, home_lineup_files):
+    """
+    Stack the away and home lineups (9 matrix files each, in batting order) into a (2, 9, 24, 124) array.
+    A team without a lineup uses matrix for every slot.
+    """
+    lineups = np.empty((2, 9) + matrix.shape)
+    for team, lineup_files in enumerate([away_lineup_files, home_lineup_files]):
+        for slot in range(9):
+            lineups[team, slot] = matrix if lineup_files is None else read_matrix(lineup_files[slot])
+    return lineups
+
+
+# Defaults for the settings that come from the checkpoint with --resume
+DEFAULTS = {"num_its": 100_000, "engine": "batch", "batch_size": 10_000}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    # --num-its, --engine and --batch-size default to None so --resume can tell if they were given (see DEFAULTS)
+    parser.add_argument(
+        "--num-its", "-n", help="Number of iterations per scenario (100,000 by default)", type=int, default=None
+    )
+    parser.add_argument("--matrix-file", "-f", help="Matrix file", type=str, default="transition_matrix.csv")
+    parser.add_argument(
+        "--stats-file",
+        help="Stats file (like the one from gen_stats_and_bsr.py) to use the exact matrix of instead of --matrix-file. "
+        "The matrix is cached in cache/matrices/, so it only gets made the first time",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--out-file", "-o", help="Output file (win_expectancy.<format> by default)", type=str, default=None
+    )
+    parser.add_argument(
+        "--format",
+        help="Output format. npy is a NumPy structured array that can be memory-mapped",
+        choices=["csv", "parquet", "npy"],
+        default="csv",
+    )
+    parser.add_argument(
+        "--engine",
+        "-e",
+        help="scalar plays one game at a time, batch plays --batch-size games at once with NumPy, half-inning is "
+        "batch but only the first half-inning of each game is played plate appearance by plate appearance, exact "
+        "solves for the win expectancy from the matrix without simulating (--num-its is ignored)",
+        choices=["scalar", "batch", "half-inning", "exact"],
+        default=None,
+    )
+    parser.add_argument(
+        "--batch-size", "-b", help="Games per batch for the batch engine (10,000 by default)", type=int, default=None
+    )
+    parser.add_argument(
+        "--workers", "-w", help="Number of processes to split the scenarios across", type=int, default=1
+    )
+    parser.add_argument("--seed", "-s", help="Random seed, for reproducible simulations", type=int, default=None)
+    parser.add_argument(
+        "--target-se",
+        "-t",
+        help="Keep simulating each scenario until the standard error of its win expectancy is below this (or "
+        "--num-its games have been played). Adds the sample count and standard error of each row to the output",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--checkpoint", "-c", help="Periodically save the simulation's progress to this file", type=str, default=None
+    )
+    parser.add_argument(
+        "--checkpoint-interval", help="Seconds between checkpoints (plus one on ctrl-C)", type=float, default=300
+    )
+    parser.add_argument(
+        "--resume",
+        "-r",
+        help="Continue the run saved in this checkpoint. Its matrix, --seed, --num-its, --engine, --batch-size and "
+        "--target-se are used, so passing different ones is an error",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--away-lineup",
+        help="9 matrix files, one per away batter in batting order (batch engine only)",
+        type=str,
+        nargs=9,
+        default=None,
+    )
+    parser.add_argument(
+        "--home-lineup",
+        help="9 matrix files, one per home batter in batting order (batch engine only)",
+        type=str,
+        nargs=9,
+        default=None,
+    )
+    parser.add_argument(
+        "--lineup-out-file",
+        help="Output file for the win expectancy at the start of each half-inning by the lineup slot leading off "
+        "(win_expectancy_lineup.<format> by default)",
+        type=str,
+        default=None,
+    )
+
+    args = parser.parse_args(sys.argv[1:])
+    if args.out_file is None:
+        args.out_file = f"win_expectancy.{args.format}"
+    if args.lineup_out_file is None:
+        args.lineup_out_file = f"win_expectancy_lineup.{args.format}"
+    resume = None
+    if args.resume is not None:
+        resume = load_checkpoint(args.resume)
+        matrix = resume["matrix"]
+        for name in ("matrix_file", "stats_file", "away_lineup", "home_lineup"):
+            if getattr(args, name) != parser.get_default(name):
+                print(
+                    f"--{name.replace('_', '-')} can't be used with --resume, the checkpoint has its matrix",
+                    file=sys.stderr,
+                )
+                sys.exit(1)
+        settings = {
+            "seed": int(resume["entropy"]),
+            "num_its": int(resume["num_its"]),
+            "engine": str(resume["engine"]),
+            "batch_size": int(resume["batch_size"]),
+            "target_se": None if np.isnan(resume["target_se"]) else float(resume["target_se"]),
+        }
+        for name, value in settings.items():
+            if getattr(args, name) not in (None, value):
+                print(
+                    f"--{name.replace('_', '-')} {getattr(args, name)} doesn't match the checkpoint's {value}",
+                    file=sys.stderr,
+                )
+                sys.exit(1)
+            setattr(args, name, value)
+        if args.checkpoint is None:
+            args.checkpoint = args.resume
+    else:
+        for name, value in DEFAULTS.items():
+            if getattr(args, name) is None:
+                setattr(args, name, value)
+        if args.stats_file is not None:
+            with open(args.stats_file) as f:
+                stats = json.load(f)
+            try:
+                matrix = cached_transition_matrix(stats)
+            except ValueError as e:
+                print(f"{args.stats_file}: {e}", file=sys.stderr)
+                sys.exit(1)
+        try:
+            if args.stats_file is None:
+                matrix = read_matrix(args.matrix_file)
+            if args.away_lineup is not None or args.home_lineup is not None:
+                matrix = lineup_matrices(matrix, args.away_lineup, args.home_lineup)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+    if matrix.ndim == 4 and args.engine != "batch":
+        print("Lineups only work with --engine batch", file=sys.stderr)
+        sys.exit(1)
+
+    if args.engine == "exact":
+        win_percent = exact_win_expectancy(matrix)
+    else:
+        win_count, game_count, slot_win_count, slot_game_count = simulate_scenarios(
+            matrix,
+            args.num_its,
+            args.engine,
+            args.batch_size,
+            workers=args.workers,
+            seed=args.seed,
+            target_se=args.target_se,
+            checkpoint_file=args.checkpoint,
+            checkpoint_interval=args.checkpoint_interval,
+            resume=resume,
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            win_percent = np.divide(win_count, game_count)
+            standard_errors = standard_error(win_count, game_count)
+    adaptive = args.target_se is not None and args.engine != "exact"
+    inning_bottom, inning, run_diff_for_home_team, base_state, outs = decode_states(np.arange(NUM_STATES))
     win_percent_arr = pd.DataFrame(
-        columns=[
-            "inning",
-            "is_bottom",
-            "run_diff_for_home",
-            "base_state",
-            "outs",
-            "win_expectancy",
-        ]
-    )
-    for index, row in enumerate(win_percent):
-        inning_bottom = index % 2
-        inning = (index // 2) % 10 + 1
-        run_diff_for_home_team = (index // 2 // 10) % 61 - 30
-        base_state = (index // 2 // 10 // 61) % 8
-        outs = (index // 2 // 10 // 61 // 8) % 3
-        # if row[0] == np.nan:
-        #     row[0] = win_percent.loc[index - 1][0]
-        #     win_percent.loc[index][0] = row[0]
-        win_percent_arr.loc[index] = [
-            inning,
-            bool(inning_bottom),
-            run_diff_for_home_team,
-            base_state,
-            outs,
-            row[0],
-        ]
+        {
+            "inning": inning.astype(np.int8),
+            "is_bottom": inning_bottom.astype(bool),
+            "run_diff_for_home": run_diff_for_home_team.astype(np.int8),
+            "base_state": base_state.astype(np.int8),
+            "outs": outs.astype(np.int8),
+            "win_expectancy": win_percent,
+        }
+    )
+    if adaptive:
+        win_percent_arr["games"] = game_count
+        win_percent_arr["standard_error"] = standard_errors
 
-    win_percent_arr.to_csv(args.out_file, index=False)
+    write_table(win_percent_arr, args.out_file, args.format)
+
+    if matrix.ndim == 4:
+        slot_index, inning_bottom = np.divmod(np.arange(NUM_SLOT_STATES), 2)
+        slot_index, inning = np.divmod(slot_index, 10)
+        leadoff_slot, run_diff = np.divmod(slot_index, 61)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slot_win_percent = np.divide(slot_win_count, slot_game_count)
+        write_table(
+            pd.DataFrame(
+                {
+                    "inning": (inning + 1).astype(np.int8),
+                    "is_bottom": inning_bottom.astype(bool),
+                    "run_diff_for_home": (run_diff - 30).astype(np.int8),
+                    "leadoff_slot": (leadoff_slot + 1).astype(np.int8),
+                    "win_expectancy": slot_win_percent,
+                    "games": slot_game_count,
+                }
+            ),
+            args.lineup_out_file,
+            args.format,
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,116 @@
+import math
+from itertools import accumulate
+from typing import NamedTuple
+
+import numpy as np
+
+# Plays runners can take an extra base on and the runners taking it, in the order the XBT tables are indexed by
+SINGLE, DOUBLE, GROUNDOUT, FLYOUT, LINEOUT = range(5)
+XBT_PLAYS = {"1B": SINGLE, "2B": DOUBLE, "GOut": GROUNDOUT, "FOut": FLYOUT, "LOut": LINEOUT}
+FIRST, SECOND, THIRD = range(3)
+RUNNERS = {"1B": FIRST, "2B": SECOND, "3B": THIRD}
+EVENTS = ("1B", "2B", "3B", "HR", "BB", "HBP", "K", "Outs")
+
+
+class Choice(NamedTuple):
+    """
+    A decision with more than two ways to go: the keys, the probability of each one, and the running total of their
+    weights (what random.choices takes as cum_weights)
+    """
+
+    keys: tuple
+    probabilities: np.ndarray
+    cumulative: tuple[float, ...]
+
+
+def make_choice(name: str, keys, weights) -> Choice:
+    weights = np.array(weights, dtype=float)
+    if not np.all(np.isfinite(weights)) or np.any(weights < 0):
+        raise ValueError(f"{name} has to be finite and not negative, got {weights.tolist()}")
+    if not weights.sum() > 0:
+        raise ValueError(f"{name} has to add up to more than 0")
+    return Choice(tuple(keys), weights / weights.sum(), tuple(accumulate(weights.tolist())))
+
+
+def check_rate(name: str, rate: float) -> float:
+    """
+    NaN rates (situations that never came up in the data, see rate() in gen_stats_and_bsr.py) count as never happening
+    """
+    if math.isnan(rate):
+        return 0.0
+    if not 0 <= rate <= 1:
+        raise ValueError(f"{name} has to be between 0 and 1, got {rate}")
+    return float(rate)
+
+
+class StatsPlan:
+    """
+    stats.json checked once and compiled into what play() in generate_transition_matrix_from_stats.py needs: the
+    steal, GIDP and out type rates worked out ahead of time, the events and GIDP failures as Choices, and the XBT
+    rates in arrays indexed by [play, runner, outs] (see XBT_PLAYS and RUNNERS).
+    """
+
+    __slots__ = (
+        "events",
+        "steal_attempt",
+        "steal_caught",
+        "out_types",
+        "xbt_attempt",
+        "xbt_success",
+        "gidp_rate",
+        "gidp_failure_outs",
+        "gidp_failure_2b",
+        "gidp_failure_loaded",
+    )
+
+    def __init__(self, stats: dict):
+        try:
+            self._compile(stats)
+        except KeyError as e:
+            raise ValueError(f"Unknown or missing key {e} in the stats") from e
+
+    def _compile(self, stats: dict):
+        events = stats["stats"]
+        for event in events:
+            if event not in EVENTS:
+                raise ValueError(f"Unknown event {event}")
+        self.events = make_choice("stats", events, list(events.values()))
+        if abs(self.events.cumulative[-1] - 1) > 1e-6:
+            raise ValueError(f"stats has to add up to 1, got {self.events.cumulative[-1]}")
+
+        # Steal attempt and caught stealing rates for second and third
+        self.steal_attempt = np.zeros(2)
+        self.steal_caught = np.zeros(2)
+        for i, base in enumerate(["2", "3"]):
+            stolen, caught, opportunities = (stats["sb"][stat] for stat in (f"SB{base}", f"CS{base}", f"SB{base}O"))
+            if not opportunities > 0:
+                raise ValueError(f"sb.SB{base}O has to be more than 0")
+            self.steal_attempt[i] = check_rate(f"sb.SB{base} + sb.CS{base}", (stolen + caught) / opportunities)
+            if stolen + caught:
+                self.steal_caught[i] = check_rate(f"sb.CS{base}", caught / (stolen + caught))
+
+        out_type_rates = [stats["groundout_rate"], stats["flyout_rate"], stats["lineout_rate"]]
+        self.out_types = make_choice("The out type rates", (GROUNDOUT, FLYOUT, LINEOUT), out_type_rates)
+        if abs(self.out_types.cumulative[-1] - 1) > 1e-6:
+            raise ValueError(f"The out type rates have to add up to 1, got {self.out_types.cumulative[-1]}")
+
+        # Combinations that don't come up (like a runner on first tagging up with 2 outs) stay at 0
+        self.xbt_attempt = np.zeros((len(XBT_PLAYS), len(RUNNERS), 3))
+        self.xbt_success = np.zeros((len(XBT_PLAYS), len(RUNNERS), 3))
+        for name, table in (("xbt_attempt_rate", self.xbt_attempt), ("xbt_success_rate", self.xbt_success)):
+            for play, runners in stats[name].items():
+                for runner, rates in runners.items():
+                    for outs, rate in enumerate(rates):
+                        table[XBT_PLAYS[play], RUNNERS[runner], outs] = check_rate(
+                            f"{name}.{play}.{runner}[{outs}]", rate
+                        )
+
+        self.gidp_rate = check_rate("gidp_rate", stats["gidp_rate"])
+        self.gidp_failure_outs = check_rate("gidp_failure_outs.B", stats["gidp_failure_outs"]["B"])
+        # Which runner is out when a double play with runners on first and second (or the bases loaded) fails
+        keys = ("B", "1B", "2B")
+        failures = [stats["gidp_failure_outs_2b"][key] for key in keys]
+        self.gidp_failure_2b = make_choice("gidp_failure_outs_2b", keys, failures)
+        keys = ("B", "1B", "2B", "3B")
+        failures = [stats["gidp_failure_outs_loaded"][key] for key in keys]
+        self.gidp_failure_loaded = make_choice("gidp_failure_outs_loaded", keys, failures)